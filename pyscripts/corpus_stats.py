@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import csv
+import json
+import re
+
+import numpy as np
+
+from utils import resolve_path_relative_to_script
+
+STATS_DIR = "../stats"
+METADATA_PATH = "../metadata/witnesses.json"
+# token kinds counted per verse, see table_2_tei.verse_tokens
+METRICS = ("abbr", "lig", "rub", "initial", "lombard", "gap", "del", "add", "unclear")
+METRIC_INDEX = {kind: index for index, kind in enumerate(METRICS)}
+FRONT_PAGE = "front"
+# verse_layout of witnesses.json: "Verse abgesetzt" (one verse per line) or
+# "Verse nicht abgesetzt" (run-on), optionally restricted to "Bl. 9r–10r"
+SET_OFF_PATTERN = re.compile(r"(?<!nicht )Verse abgesetzt")
+FOLIO_RANGE_PATTERN = re.compile(r"Bl\.\s*(\w+)(?:\s*[–-]\s*(\w+))?")
+
+
+def lines_per_page_range(value: object) -> tuple[int, int] | None:
+    # "22–26", "23, auch 22", 28 ... -> (smallest, largest) documented count
+    numbers = [int(number) for number in re.findall(r"\d+", str(value or ""))]
+    if not numbers:
+        return None
+    return min(numbers), max(numbers)
+
+
+def set_off_pages(verse_layout: object, pages: list[str]) -> np.ndarray:
+    """Mask of the pages whose verses are set off, i.e. verses per page are lines per page."""
+    mask = np.zeros(len(pages), dtype=bool)
+    for clause in str(verse_layout or "").split(";"):
+        if not SET_OFF_PATTERN.search(clause):
+            continue
+        folios = FOLIO_RANGE_PATTERN.search(clause)
+        if folios is None:
+            mask[:] = True
+            continue
+        first, last = folios.group(1), folios.group(2) or folios.group(1)
+        if first in pages and last in pages:
+            mask[pages.index(first):pages.index(last) + 1] = True
+    return mask
+
+
+class WitnessStats:
+    def __init__(self, siglum: str, witness) -> None:
+        self.siglum = siglum
+        verse_count = len(witness.parsed)
+        # one row per verse row of the sheet, one column per metric
+        self.counts = np.zeros((verse_count, len(METRICS)), dtype=np.int32)
+        self.non_empty = np.zeros(verse_count, dtype=np.int32)
+        self.page_ids = np.zeros(verse_count, dtype=np.int32)
+        self.pages = [FRONT_PAGE]
+        expansions: list[str] = []
+        next_page = None
+        for row, ((verse, _), tokens) in enumerate(zip(witness.parsed, witness.verse_tokens())):
+            if next_page is not None:
+                self.pages.append(next_page)
+                next_page = None
+            self.non_empty[row] = verse.local_count != ""
+            leading = True
+            for token in tokens:
+                if token.kind == "pb":
+                    if leading:
+                        # verse starts on the new page
+                        self.pages.append(token.dipl)
+                    else:
+                        next_page = token.dipl
+                    continue
+                if token.kind == "text" and not token.dipl.strip():
+                    continue
+                leading = False
+                index = METRIC_INDEX.get(token.kind)
+                if index is not None:
+                    self.counts[row, index] += 1
+                if token.kind == "abbr":
+                    expansions.append(token.norm)
+            self.page_ids[row] = len(self.pages) - 1
+        self.expansions, self.expansion_counts = (
+            np.unique(np.array(expansions, dtype=str), return_counts=True)
+            if expansions
+            else (np.array([], dtype=str), np.array([], dtype=np.int64))
+        )
+
+    def totals(self) -> np.ndarray:
+        return self.counts.sum(axis=0)
+
+    def page_counts(self) -> tuple[np.ndarray, np.ndarray]:
+        """Verses and metric counts per page, summed with bincount/add.at."""
+        verses = np.bincount(self.page_ids, weights=self.non_empty, minlength=len(self.pages))
+        metrics = np.zeros((len(self.pages), len(METRICS)), dtype=np.int64)
+        np.add.at(metrics, self.page_ids, self.counts)
+        return verses.astype(np.int64), metrics
+
+
+class CorpusStats:
+    """Collects per-witness counts during the build and writes them as CSV tables."""
+
+    def __init__(self, metadata_path: str = METADATA_PATH) -> None:
+        self.witnesses: dict[str, WitnessStats] = {}
+        # (siglum, page) not compared with lines_per_page, see set_off_pages
+        self.skipped: list[tuple[str, str]] = []
+        with open(resolve_path_relative_to_script(metadata_path), "r", encoding="utf-8") as file:
+            self.metadata = json.load(file)
+
+    def add_witness(self, witness) -> None:
+        self.witnesses[witness.siglum] = WitnessStats(witness.siglum, witness)
+
+    def codicology(self, siglum: str) -> dict:
+        return self.metadata.get(siglum, {}).get("metadata", {}).get("codicology", {})
+
+    def documented_lines(self, siglum: str) -> tuple[int, int] | None:
+        return lines_per_page_range(self.codicology(siglum).get("lines_per_page"))
+
+    def write(self, out_dir: str = STATS_DIR) -> list[tuple[str, str, int]]:
+        """Write the tables; returns the flagged (siglum, page, verses) entries.
+
+        Only pages with verses set off are compared with lines_per_page, on
+        run-on pages the verse count says nothing about the lines; the others
+        are collected in self.skipped and marked in page_stats.csv.
+        """
+        self.skipped = []
+        out_path = resolve_path_relative_to_script(out_dir)
+        out_path.mkdir(parents=True, exist_ok=True)
+        flagged: list[tuple[str, str, int]] = []
+        with open(out_path / "witness_stats.csv", "w", encoding="utf-8", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["siglum", "verses", "pages", *METRICS])
+            for siglum, stats in self.witnesses.items():
+                writer.writerow(
+                    [siglum, int(stats.non_empty.sum()), len(stats.pages) - 1, *stats.totals().tolist()]
+                )
+        with open(out_path / "page_stats.csv", "w", encoding="utf-8", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(
+                ["siglum", "page", "verses", *METRICS, "lines_per_page", "compared", "flagged"]
+            )
+            for siglum, stats in self.witnesses.items():
+                verses, metrics = stats.page_counts()
+                documented = self.documented_lines(siglum)
+                compared = set_off_pages(self.codicology(siglum).get("verse_layout"), stats.pages)
+                if documented is not None:
+                    outside = (verses < documented[0]) | (verses > documented[1])
+                else:
+                    outside = np.zeros(len(verses), dtype=bool)
+                for page_id, page in enumerate(stats.pages):
+                    if page == FRONT_PAGE and verses[page_id] == 0:
+                        continue
+                    # verses before the first <pb/> are not on a known page
+                    is_compared = bool(compared[page_id]) and documented is not None and page != FRONT_PAGE
+                    if not is_compared and page != FRONT_PAGE:
+                        self.skipped.append((siglum, page))
+                    is_flagged = is_compared and bool(outside[page_id])
+                    if is_flagged:
+                        flagged.append((siglum, page, int(verses[page_id])))
+                    writer.writerow(
+                        [
+                            siglum,
+                            page,
+                            int(verses[page_id]),
+                            *metrics[page_id].tolist(),
+                            "-".join(map(str, documented)) if documented else "",
+                            "x" if is_compared else "",
+                            "x" if is_flagged else "",
+                        ]
+                    )
+        with open(out_path / "abbreviations.csv", "w", encoding="utf-8", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["siglum", "expansion", "count"])
+            for siglum, stats in self.witnesses.items():
+                order = np.argsort(-stats.expansion_counts, kind="stable")
+                for index in order:
+                    writer.writerow([siglum, stats.expansions[index], int(stats.expansion_counts[index])])
+        return flagged
@@ -0,0 +1,215 @@
+from __future__ import annotations
+
+import argparse
+import csv
+import hashlib
+import io
+import json
+import mmap
+from pathlib import Path
+
+import numpy as np
+
+from utils import resolve_path_relative_to_script
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = ".idx"
+MASTER_COLUMN = "Meisterzählung"
+
+
+def index_path(csv_path: Path) -> Path:
+    # sidecar directory next to the CSV
+    return csv_path.with_name(csv_path.name + INDEX_SUFFIX)
+
+
+def file_hash(path: Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def scan_rows(data: bytes):
+    """(byte offset, cells) of every record, header first.
+
+    The lines are fed to csv.reader like the build reads the file, so a quoted
+    cell spanning several lines stays one record.
+    """
+    line_starts: list[int] = []
+
+    def lines():
+        position = 0
+        for line in io.BytesIO(data):
+            line_starts.append(position)
+            position += len(line)
+            yield line.decode("utf-8")
+
+    consumed = 0
+    for cells in csv.reader(lines()):
+        yield line_starts[consumed], cells
+        consumed = len(line_starts)
+
+
+def build_csv_index(csv_path: Path, digest: str | None = None) -> Path:
+    """Write row offsets and per-column non-empty bitmaps of the CSV."""
+    data = csv_path.read_bytes()
+    records = scan_rows(data)
+    _, header = next(records)
+    # offsets[n] is the start of row n (row 0 is the header), the last one the file end
+    offsets = [0]
+    masters = [0]
+    filled = []
+    for offset, cells in records:
+        offsets.append(offset)
+        master = cells[0].strip() if cells else ""
+        masters.append(int(master) if master.isdigit() else -1)
+        filled.append([index < len(cells) and cells[index].strip() != "" for index in range(len(header))])
+    offsets.append(len(data))
+    # bit n of a column's bitmap is row n; the header bit stays 0
+    mask = np.zeros((len(header), len(offsets) - 1), dtype=bool)
+    if filled:
+        mask[:, 1:] = np.array(filled, dtype=bool).T
+    masters_array = np.array(masters, dtype="<i4")
+    row_of_master = np.zeros(max(masters_array.max(initial=0), 0) + 1, dtype="<i4")
+    numbered = np.flatnonzero(masters_array > 0)
+    row_of_master[masters_array[numbered]] = numbered
+    target = index_path(csv_path)
+    tmp_target = target.with_name(target.name + ".part")
+    tmp_target.mkdir(parents=True, exist_ok=True)
+    np.save(tmp_target / "offsets.npy", np.array(offsets, dtype="<i8"))
+    np.save(tmp_target / "bitmaps.npy", np.packbits(mask, axis=1))
+    np.save(tmp_target / "row_of_master.npy", row_of_master)
+    stat = csv_path.stat()
+    with open(tmp_target / "meta.json", "w", encoding="utf-8") as file:
+        json.dump(
+            {
+                "version": INDEX_VERSION,
+                "sha256": digest or hashlib.sha256(data).hexdigest(),
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "header": header,
+                "rows": len(offsets) - 2,
+            },
+            file,
+        )
+    if target.is_dir():
+        for old in target.iterdir():
+            old.unlink()
+        target.rmdir()
+    tmp_target.replace(target)
+    return target
+
+
+def update_csv_index(csv_path: str | Path) -> Path:
+    """Index of the CSV, rebuilt only when its content hash changed."""
+    csv_path = resolve_path_relative_to_script(str(csv_path))
+    target = index_path(csv_path)
+    meta_path = target / "meta.json"
+    if not meta_path.is_file():
+        return build_csv_index(csv_path)
+    with open(meta_path, "r", encoding="utf-8") as file:
+        meta = json.load(file)
+    stat = csv_path.stat()
+    if meta.get("version") != INDEX_VERSION:
+        return build_csv_index(csv_path)
+    if (meta["size"], meta["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns):
+        return target
+    # the workbook conversion rewrites the CSV every run, compare the content
+    digest = file_hash(csv_path)
+    if digest != meta["sha256"]:
+        return build_csv_index(csv_path, digest)
+    meta.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    with open(meta_path, "w", encoding="utf-8") as file:
+        json.dump(meta, file)
+    return target
+
+
+class CSVIndex:
+    """Random access to the rows of the transcription CSV.
+
+    Offsets and bitmaps are memory-mapped, the CSV itself too; a row is read
+    by slicing between two offsets.
+    """
+
+    def __init__(self, csv_path: str | Path):
+        self.csv_path = resolve_path_relative_to_script(str(csv_path))
+        path = update_csv_index(self.csv_path)
+        with open(path / "meta.json", "r", encoding="utf-8") as file:
+            self.meta = json.load(file)
+        self.header: list[str] = self.meta["header"]
+        self.row_count: int = self.meta["rows"]
+        self.offsets = np.load(path / "offsets.npy", mmap_mode="r")
+        self.bitmaps = np.load(path / "bitmaps.npy", mmap_mode="r")
+        self.row_of_master = np.load(path / "row_of_master.npy", mmap_mode="r")
+        with open(self.csv_path, "rb") as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        self.data.close()
+
+    def __enter__(self) -> "CSVIndex":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def column(self, name: str) -> int:
+        if name not in self.header:
+            raise ValueError(f"Unknown column: {name}")
+        return self.header.index(name)
+
+    def row_number(self, master: int) -> int:
+        """Row (1-based, header excluded) of a Meisterzählung value, 0 if there is none."""
+        if not 0 < master < len(self.row_of_master):
+            return 0
+        return int(self.row_of_master[master])
+
+    def rows(self, first: int = 1, last: int | None = None):
+        """Cells of rows first..last (inclusive), parsed like the build reads them."""
+        last = self.row_count if last is None else min(last, self.row_count)
+        if first > last:
+            return
+        first = max(first, 1)
+        start, end = int(self.offsets[first]), int(self.offsets[last + 1])
+        text = io.TextIOWrapper(io.BytesIO(self.data[start:end]), encoding="utf-8")
+        yield from csv.reader(text)
+
+    def row(self, master: int) -> dict[str, str]:
+        row_number = self.row_number(master)
+        if not row_number:
+            raise KeyError(f"No row with {MASTER_COLUMN} {master}")
+        cells = next(self.rows(row_number, row_number))
+        return dict(zip(self.header, cells + [""] * (len(self.header) - len(cells))))
+
+    def has_text(self, siglum: str, row_number: int) -> bool:
+        byte = self.bitmaps[self.column(siglum), row_number >> 3]
+        return bool((byte >> (7 - (row_number & 7))) & 1)
+
+    def text_rows(self, siglum: str) -> np.ndarray:
+        """Numbers of the rows in which the witness has text."""
+        bits = np.unpackbits(self.bitmaps[self.column(siglum)], count=self.row_count + 1)
+        return np.flatnonzero(bits)
+
+    def text_count_before(self, siglum: str, row_number: int) -> int:
+        # local verse count of the witness just before row_number
+        bits = np.unpackbits(self.bitmaps[self.column(siglum)], count=max(row_number, 0))
+        return int(np.count_nonzero(bits))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Look up rows of the transcription CSV through its offset index."
+    )
+    parser.add_argument("csv", help="Transcription CSV, e.g. ../data/Transkription_generated.csv")
+    parser.add_argument("--row", type=int, nargs="+", default=[], help=f"Print the rows with these {MASTER_COLUMN} values.")
+    parser.add_argument("--text-rows", metavar="SIGLUM", help="Print the rows in which the witness has text.")
+    args = parser.parse_args()
+
+    with CSVIndex(args.csv) as index:
+        for master in args.row:
+            print(json.dumps(index.row(master), ensure_ascii=False))
+        if args.text_rows:
+            rows = index.text_rows(args.text_rows)
+            print(f"{args.text_rows}: {len(rows)} of {index.row_count} rows")
+            print(" ".join(str(row) for row in rows.tolist()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,67 @@
 from __future__ import annotations
 
 import argparse
+import hashlib
 import json
 import re
+from concurrent.futures import Future
+from copy import deepcopy
+from functools import lru_cache
 from pathlib import Path
 from lxml import etree
 from utils import resolve_path_relative_to_script
-from get_images_from_3if import get_info_json_urls, load_witnesses_json, get_manifest
+from get_images_from_3if import get_info_json_urls, load_witnesses_json, get_manifest, get_manifest_version
+from iiif_cache import CACHE_DIR, IIIFCache
+from tei_writer import write_tei
 
 NS_TEI = "http://www.tei-c.org/ns/1.0"
 NS_XML = "http://www.w3.org/XML/1998/namespace"
 NS = {"tei": NS_TEI, "xml": NS_XML}
+METADATA_PATH = "../metadata/witnesses.json"
+FRAGMENT_CACHE_DIR = "../.cache/metadata"
+FRAGMENT_VERSION = 1
+
+# expected shape of a witnesses.json entry; keys not listed here are allowed
+WITNESS_SCHEMA = {
+    "type": str,
+    "country": str,
+    "city": str,
+    "repository": str,
+    "signatures": [str],
+    "IIIF_manifest": str,
+    "first_scan": int,
+    "last_scan": int,
+    "handschriftencensus_id": int,
+    "handschriftencensus_url": str,
+    "former_locations": [str],
+    "notes": [str],
+    "metadata": {
+        "date": str,
+        "origin": (str, type(None)),
+        "language": str,
+        "content": [str],
+        "codicology": {
+            "material": str,
+            "extent": str,
+            "leaf_size": str,
+            "writing_area": str,
+            "columns": int,
+            "lines_per_page": (int, str),
+            "verse_layout": str,
+            "features": [str],
+        },
+    },
+    "parts": [
+        {
+            "country": str,
+            "city": str,
+            "repository": str,
+            "signature": str,
+            "extent": str,
+            "former_locations": [str],
+        }
+    ],
+}
 
 
 def tei(tag: str, attrs: dict[str, str] | None = None) -> etree._Element:
@@ -36,6 +87,54 @@ def parse_witness_metadata(metadata_path: Path) -> dict[str, dict]:
         return json.load(f)
 
 
+def schema_errors(value: object, schema: object, path: str) -> list[str]:
+    if isinstance(schema, dict):
+        if not isinstance(value, dict):
+            return [f"{path}: expected an object"]
+        return [
+            error
+            for key, sub_schema in schema.items()
+            if key in value
+            for error in schema_errors(value[key], sub_schema, f"{path}.{key}")
+        ]
+    if isinstance(schema, list):
+        if not isinstance(value, list):
+            return [f"{path}: expected a list"]
+        return [
+            error
+            for index, item in enumerate(value)
+            for error in schema_errors(item, schema[0], f"{path}[{index}]")
+        ]
+    if not isinstance(value, schema) or isinstance(value, bool):
+        expected = " or ".join(
+            t.__name__ for t in (schema if isinstance(schema, tuple) else (schema,))
+        )
+        return [f"{path}: expected {expected}, got {type(value).__name__}"]
+    return []
+
+
+def validate_witness_metadata(metadata: object) -> None:
+    if not isinstance(metadata, dict):
+        raise ValueError("Invalid witness metadata: expected an object of sigla")
+    errors = []
+    for siglum, witness in metadata.items():
+        errors.extend(schema_errors(witness, WITNESS_SCHEMA, siglum))
+        if isinstance(witness, dict) and "IIIF_manifest" in witness:
+            for key in ("first_scan", "last_scan"):
+                if key not in witness:
+                    errors.append(f"{siglum}: IIIF_manifest given without {key}")
+    if errors:
+        raise ValueError("Invalid witness metadata:\n" + "\n".join(errors))
+
+
+@lru_cache(maxsize=4)
+def load_witness_metadata(path: str, mtime_ns: int) -> dict[str, dict]:
+    # parsed and validated once per version of the file
+    metadata = parse_witness_metadata(Path(path))
+    validate_witness_metadata(metadata)
+    return metadata
+
+
 def extract_written_lines(value: object) -> str:
     if value is None:
         return ""
@@ -221,7 +320,20 @@ def build_parts(parent: etree._Element, witness: dict) -> None:
             extent_el.text = extent
 
 
-def replace_ms_desc(root: etree._Element, siglum: str, witness: dict) -> bool:
+def build_ms_desc(siglum: str, witness: dict) -> etree._Element:
+    ms_desc = tei("msDesc", {f"{{{NS_XML}}}id": siglum})
+    build_ms_identifier(ms_desc, siglum, witness)
+    build_ms_contents(ms_desc, witness)
+    build_phys_desc(ms_desc, witness)
+    build_history(ms_desc, witness)
+    build_additional_notes(ms_desc, witness)
+    build_parts(ms_desc, witness)
+    return ms_desc
+
+
+def replace_ms_desc(
+    root: etree._Element, siglum: str, witness: dict, ms_desc: etree._Element | None = None
+) -> bool:
     source_desc = root.find(
         ".//tei:teiHeader/tei:fileDesc/tei:sourceDesc", namespaces=NS
     )
@@ -235,13 +347,7 @@ def replace_ms_desc(root: etree._Element, siglum: str, witness: dict) -> bool:
     for old_ms_desc in source_desc.findall("tei:msDesc", namespaces=NS):
         source_desc.remove(old_ms_desc)
 
-    ms_desc = tei_sub(source_desc, "msDesc", {f"{{{NS_XML}}}id": siglum})
-    build_ms_identifier(ms_desc, siglum, witness)
-    build_ms_contents(ms_desc, witness)
-    build_phys_desc(ms_desc, witness)
-    build_history(ms_desc, witness)
-    build_additional_notes(ms_desc, witness)
-    build_parts(ms_desc, witness)
+    source_desc.append(ms_desc if ms_desc is not None else build_ms_desc(siglum, witness))
     return True
 
 
@@ -265,18 +371,196 @@ def get_facsimile_element(urls):
     return facsimile
 
 
+def facsimile_urls(
+    witness: dict,
+    image_cache: IIIFCache | None = None,
+    image_base_url: str | None = None,
+) -> list[str] | None:
+    manifest_url = witness.get("IIIF_manifest", None)
+    if manifest_url is None:
+        return None
+    if image_cache is not None:
+        # manifest from the prefetch cache, graphic urls point at it
+        manifest = image_cache.fetch_json(manifest_url)
+    else:
+        manifest  = get_manifest(manifest_url)
+    urls = get_info_json_urls(
+        manifest,
+        witness["first_scan"],
+        witness["last_scan"],
+    )
+    if image_cache is not None:
+        urls = [image_cache.local_image_url(url, image_base_url) for url in urls]
+    return urls
+
+
+class FragmentCache:
+    """Serialized msDesc and facsimile per witness under .cache/metadata.
+
+    The key hashes the witness entry of witnesses.json and, for witnesses
+    with a IIIF manifest, what identifies the manifest: its ETag or
+    Last-Modified (one HEAD request) or, when images come from the IIIF
+    cache, the resolved graphic URLs. A changed entry or manifest gets a new
+    file; otherwise the manifest is not downloaded again.
+    """
+
+    def __init__(self, cache_dir: str = FRAGMENT_CACHE_DIR, refresh: bool = False):
+        self.cache_dir = resolve_path_relative_to_script(cache_dir)
+        self.refresh = refresh
+
+    def key(self, siglum: str, witness: dict, manifest: str | None = None) -> str:
+        digest = hashlib.sha256()
+        digest.update(f"fragments{FRAGMENT_VERSION}:{siglum}:".encode("utf-8"))
+        digest.update(json.dumps(witness, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+        entry = digest.hexdigest()[:16]
+        if manifest is None:
+            return entry
+        return f"{entry}-{hashlib.sha256(manifest.encode('utf-8')).hexdigest()[:16]}"
+
+    def path(self, siglum: str, witness: dict, manifest: str | None = None) -> Path:
+        return self.cache_dir / f"{siglum}-{self.key(siglum, witness, manifest)}.xml"
+
+    def manifest_inputs(
+        self,
+        siglum: str,
+        witness: dict,
+        image_cache: IIIFCache | None = None,
+        image_base_url: str | None = None,
+    ) -> tuple[str | None, list[str] | None]:
+        """Manifest identity for the key and the facsimile URLs, if these are needed.
+
+        The network part of fragments(); pipeline.ManifestFetches runs it in
+        the background.
+        """
+        if "IIIF_manifest" not in witness:
+            return None, None
+        if image_cache is not None:
+            urls = facsimile_urls(witness, image_cache, image_base_url)
+            return "\n".join(urls), urls
+        version = get_manifest_version(witness["IIIF_manifest"])
+        if not self.refresh and self.path(siglum, witness, version).is_file():
+            return version, None
+        return version, facsimile_urls(witness)
+
+    def fragments(
+        self,
+        siglum: str,
+        witness: dict,
+        image_cache: IIIFCache | None = None,
+        image_base_url: str | None = None,
+        inputs: tuple[str | None, list[str] | None] | None = None,
+    ) -> tuple[etree._Element, etree._Element | None]:
+        """msDesc and facsimile (None without IIIF manifest) of one witness.
+
+        inputs is the result of manifest_inputs if it ran beforehand.
+        """
+        if inputs is None:
+            inputs = self.manifest_inputs(siglum, witness, image_cache, image_base_url)
+        manifest, urls = inputs
+        path = self.path(siglum, witness, manifest)
+        if path.is_file() and not self.refresh:
+            wrapper = load_fragment_file(str(path))
+        else:
+            wrapper = etree.Element(f"{{{NS_TEI}}}fragments", nsmap={None: NS_TEI})
+            wrapper.append(build_ms_desc(siglum, witness))
+            if urls is None and manifest is not None:
+                urls = facsimile_urls(witness)
+            if urls is not None:
+                wrapper.append(get_facsimile_element(urls))
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            for stale in self.cache_dir.glob(f"{siglum}-*.xml"):
+                stale.unlink()
+            tmp_path = path.with_suffix(".part")
+            etree.ElementTree(wrapper).write(str(tmp_path), encoding="utf-8", xml_declaration=True)
+            tmp_path.replace(path)
+        # trees get copies, the parsed fragments stay reusable within the process
+        ms_desc, *facsimile = [deepcopy(child) for child in wrapper]
+        return ms_desc, facsimile[0] if facsimile else None
+
+    def previous_facsimile(
+        self, siglum: str, witness: dict, tei_file: Path | None = None
+    ) -> etree._Element | None:
+        """Facsimile of the last cached fragments of this entry, else the one in tei_file.
+
+        Used when the manifest cannot be read; no network access.
+        """
+        cached = sorted(
+            self.cache_dir.glob(f"{siglum}-{self.key(siglum, witness)}-*.xml"),
+            key=lambda path: path.stat().st_mtime_ns,
+        )
+        if cached:
+            wrapper = load_fragment_file(str(cached[-1]))
+            if len(wrapper) > 1:
+                return deepcopy(wrapper[1])
+        if tei_file is not None and tei_file.is_file():
+            for _, facsimile in etree.iterparse(str(tei_file), tag=f"{{{NS_TEI}}}facsimile"):
+                return deepcopy(facsimile)
+        return None
+
+
+@lru_cache(maxsize=64)
+def load_fragment_file(path: str) -> etree._Element:
+    # file names contain the content key, a path never changes its content
+    return etree.parse(path).getroot()
+
+
+def enrich_tree(
+    root: etree._Element,
+    siglum: str,
+    witness: dict,
+    fragment_cache: FragmentCache,
+    image_cache: IIIFCache | None = None,
+    image_base_url: str | None = None,
+    inputs: tuple[str | None, list[str] | None] | Future | None = None,
+    previous_file: Path | None = None,
+) -> Exception | None:
+    """Put the msDesc and facsimile of a witness into its TEI tree, in memory.
+
+    inputs is the result of FragmentCache.manifest_inputs or a Future of it.
+    If the manifest cannot be read, the msDesc still goes in (it needs no
+    network) with the previous facsimile (cached, or that of previous_file);
+    the error is returned.
+    """
+    error = None
+    try:
+        if isinstance(inputs, Future):
+            inputs = inputs.result()
+        ms_desc, facs_elem = fragment_cache.fragments(siglum, witness, image_cache, image_base_url, inputs)
+    except Exception as exc:
+        error = exc
+        ms_desc = build_ms_desc(siglum, witness)
+        facs_elem = fragment_cache.previous_facsimile(siglum, witness, previous_file)
+    replace_ms_desc(root, siglum, witness, ms_desc)
+    for old_facsimile in root.findall("tei:facsimile", namespaces=NS):
+        # enriching a file again must not add a second facsimile
+        root.remove(old_facsimile)
+    if facs_elem is not None:
+        root.xpath(".//tei:teiHeader", namespaces=NS)[0].addnext(facs_elem)
+    return error
+
+
 def enrich_tei_files(
-    metadata_path: str = "../metadata/witnesses.json", tei_dir: str = "../tei"
+    metadata_path: str = METADATA_PATH,
+    tei_dir: str = "../tei",
+    sigla: list[str] | None = None,
+    image_cache: IIIFCache | None = None,
+    image_base_url: str | None = None,
+    fragment_cache: FragmentCache | None = None,
 ) -> tuple[int, int, list[str]]:
     metadata_file = resolve_path_relative_to_script(metadata_path)
     tei_folder = resolve_path_relative_to_script(tei_dir)
 
-    metadata = parse_witness_metadata(metadata_file)
+    metadata = load_witness_metadata(str(metadata_file), metadata_file.stat().st_mtime_ns)
+    if fragment_cache is None:
+        fragment_cache = FragmentCache()
     processed = 0
     updated = 0
     missing: list[str] = []
 
     for tei_file in sorted(tei_folder.glob("*.xml")):
+        # restrict to the files of selected witnesses (file name == siglum)
+        if sigla is not None and tei_file.stem not in sigla:
+            continue
         parser = etree.XMLParser(remove_blank_text=False)
         tree = etree.parse(str(tei_file), parser)
         root = tree.getroot()
@@ -289,27 +573,18 @@ def enrich_tei_files(
             missing.append(siglum)
             continue
 
-        replace_ms_desc(root, siglum, witness)
-
-        manifest_url = witness.get("IIIF_manifest", None)
-        if manifest_url is not None:
-            manifest  = get_manifest(manifest_url)
-            urls = get_info_json_urls(
-                manifest,
-                witness["first_scan"],
-                witness["last_scan"],
-            )
-            facs_elem = get_facsimile_element(urls)
-            root.xpath(".//tei:teiHeader", namespaces=NS)[0].addnext(facs_elem)
-
-        tree.write(
-            str(tei_file),
-            encoding="utf-8",
-            xml_declaration=True,
-            pretty_print=True,
+        error = enrich_tree(
+            root, siglum, witness, fragment_cache, image_cache, image_base_url, previous_file=tei_file
         )
+        if error is not None:
+            print(f"Manifest of {siglum} not read, previous facsimile kept: {type(error).__name__}: {error}")
+        # rewrites the .gz/.zst siblings written by the build as well
+        write_tei(tree, tei_file, compress=None)
         updated += 1
 
+    if image_cache is not None:
+        # the lookups above moved access times (and may have cached manifests)
+        image_cache.save_index()
     return processed, updated, missing
 
 
@@ -319,7 +594,7 @@ def main() -> None:
     )
     parser.add_argument(
         "--metadata",
-        default="../metadata/witnesses.json",
+        default=METADATA_PATH,
         help="Path to witness metadata JSON (relative to this script or absolute).",
     )
     parser.add_argument(
@@ -327,8 +602,29 @@ def main() -> None:
         default="../tei",
         help="Directory containing TEI files to enrich.",
     )
+    parser.add_argument(
+        "--image-cache",
+        nargs="?",
+        const="",
+        default=None,
+        metavar="BASE_URL",
+        help="Point <graphic @url> at the iiif_cache.py prefetch cache: file URIs, "
+        "or URLs below BASE_URL if the cache directory is served by a web server.",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Rebuild the cached msDesc/facsimile fragments even if entry and manifest are unchanged.",
+    )
     args = parser.parse_args()
-    processed, updated, missing = enrich_tei_files(args.metadata, args.tei_dir)
+    image_cache = IIIFCache(CACHE_DIR) if args.image_cache is not None else None
+    processed, updated, missing = enrich_tei_files(
+        args.metadata,
+        args.tei_dir,
+        image_cache=image_cache,
+        image_base_url=args.image_cache or None,
+        fragment_cache=FragmentCache(refresh=args.refresh),
+    )
     print(f"Processed TEI files: {processed}")
     print(f"Updated TEI files:   {updated}")
     if missing:
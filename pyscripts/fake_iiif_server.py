@@ -0,0 +1,239 @@
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import shutil
+import tempfile
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from lxml import etree
+
+from enrich_tei_with_metadata import NS, FragmentCache, enrich_tei_files
+from iiif_cache import IIIFCache, prefetch
+from utils import resolve_path_relative_to_script
+
+HOST = "127.0.0.1"
+CANVASES = 12
+IMAGE_SIZE = 64 * 1024
+# any generated witness file; its siglum becomes the one of the fake witness
+TEI_TEMPLATE = "../tei/A.xml"
+
+
+class FakeIIIFServer:
+    """Local stand-in for a IIIF server: manifests, info.json and images.
+
+    /manifest/<name> is a Presentation 3 manifest of CANVASES canvases whose
+    image services live below /image/<name>/<n>; every image request returns
+    IMAGE_SIZE bytes derived from its path and honours Range headers. hits
+    counts the requests per method and path, ranged the Range requests per
+    path. Use as a context manager.
+    """
+
+    def __init__(self, host: str = HOST, port: int = 0, canvases: int = CANVASES):
+        self.canvases = canvases
+        self.etag = "v1"
+        self.hits: Counter = Counter()
+        self.ranged: Counter = Counter()
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        self.base_url = f"http://{host}:{self.server.server_port}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self) -> "FakeIIIFServer":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def manifest_url(self, name: str) -> str:
+        return f"{self.base_url}/manifest/{name}"
+
+    def witness(self, name: str, first_scan: int = 2, last_scan: int = 5) -> dict:
+        # witnesses.json entry pointing at this server
+        return {
+            "type": "codex",
+            "country": "Testland",
+            "city": "Teststadt",
+            "repository": "Testbibliothek",
+            "signatures": [f"Cod. {name}"],
+            "IIIF_manifest": self.manifest_url(name),
+            "first_scan": first_scan,
+            "last_scan": last_scan,
+        }
+
+    def manifest(self, name: str) -> dict:
+        return {
+            "id": self.manifest_url(name),
+            "type": "Manifest",
+            "items": [
+                {
+                    "id": f"{self.base_url}/canvas/{name}/{n}",
+                    "type": "Canvas",
+                    "items": [{"items": [{"body": {"service": [{"id": f"{self.base_url}/image/{name}/{n}"}]}}]}],
+                }
+                for n in range(1, self.canvases + 1)
+            ],
+        }
+
+    def info(self, service: str) -> dict:
+        return {
+            "id": f"{self.base_url}{service}",
+            "width": 2000,
+            "height": 3000,
+            "tiles": [{"width": 1024, "scaleFactors": [1, 2, 4]}],
+        }
+
+    @staticmethod
+    def image(path: str) -> bytes:
+        seed = hashlib.sha256(path.encode("utf-8")).digest()
+        return (seed * (IMAGE_SIZE // len(seed) + 1))[:IMAGE_SIZE]
+
+    def response(self, path: str) -> tuple[bytes, str] | None:
+        parts = path.strip("/").split("/")
+        if parts[0] == "manifest" and len(parts) == 2:
+            return json.dumps(self.manifest(parts[1])).encode("utf-8"), "application/json"
+        if parts[0] == "image" and len(parts) == 4 and parts[3] == "info.json":
+            return json.dumps(self.info(path[: -len("/info.json")])).encode("utf-8"), "application/json"
+        if parts[0] == "image" and len(parts) == 7:
+            return self.image(path), "image/jpeg"
+        return None
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_HEAD(self):
+                self.answer(send_body=False)
+
+            def do_GET(self):
+                self.answer(send_body=True)
+
+            def answer(self, send_body: bool):
+                fake.hits[self.command, self.path] += 1
+                found = fake.response(self.path)
+                if found is None:
+                    self.send_error(404)
+                    return
+                body, content_type = found
+                status = 200
+                range_header = self.headers.get("Range", "")
+                if range_header.startswith("bytes="):
+                    start = int(range_header[len("bytes="):].split("-")[0])
+                    if start >= len(body):
+                        self.send_response(416)
+                        self.end_headers()
+                        return
+                    fake.ranged[self.path] += 1
+                    status, body = 206, body[start:]
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", fake.etag)
+                self.end_headers()
+                if send_body:
+                    self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def expect(condition: bool, message: str):
+    if not condition:
+        raise SystemExit(f"FAILED: {message}")
+    print(f"ok  {message}")
+
+
+def check(tei_template: str = TEI_TEMPLATE) -> None:
+    """Prefetch and enrichment against the fake server, in a temporary directory."""
+    work = Path(tempfile.mkdtemp(prefix="fake_iiif_"))
+    try:
+        with FakeIIIFServer() as server:
+            metadata_path = work / "witnesses.json"
+            metadata_path.write_text(json.dumps({"A": server.witness("A")}), encoding="utf-8")
+            cache = IIIFCache(str(work / "iiif"))
+            fetched, failed = prefetch(cache, str(metadata_path))
+            # 4 scans: info.json and one rendering each
+            expect((fetched, failed) == (8, 0), "prefetch downloads info.json and image of every scan")
+            expect((work / "iiif" / "index.json").is_file(), "prefetch writes the index")
+
+            gets = sum(count for (method, _), count in server.hits.items() if method == "GET")
+            fetched, failed = prefetch(IIIFCache(str(work / "iiif")), str(metadata_path))
+            gets_again = sum(count for (method, _), count in server.hits.items() if method == "GET")
+            expect((fetched, gets_again) == (8, gets), "a second prefetch is served from the cache")
+
+            image_url = f"{server.base_url}/image/A/3/full/!1000,1000/0/default.jpg"
+            resumed = IIIFCache(str(work / "resume"))
+            resumed.partial_dir.mkdir(parents=True)
+            partial = resumed.partial_dir / (hashlib.sha1(image_url.encode("utf-8")).hexdigest() + ".part")
+            partial.write_bytes(server.image(image_url[len(server.base_url):])[: IMAGE_SIZE // 2])
+            path = resumed.fetch(image_url)
+            expect(
+                server.ranged[image_url[len(server.base_url):]] == 1
+                and path.read_bytes() == server.image(image_url[len(server.base_url):]),
+                "an interrupted download is resumed with a Range request",
+            )
+
+            tei_dir = work / "tei"
+            tei_dir.mkdir()
+            shutil.copy(resolve_path_relative_to_script(tei_template), tei_dir / "A.xml")
+            before = json.loads((work / "iiif" / "index.json").read_text(encoding="utf-8"))["objects"]
+            enrich_cache = IIIFCache(str(work / "iiif"))
+            enrich_tei_files(
+                str(metadata_path),
+                str(tei_dir),
+                image_cache=enrich_cache,
+                fragment_cache=FragmentCache(str(work / "fragments")),
+            )
+            root = etree.parse(str(tei_dir / "A.xml")).getroot()
+            graphics = root.xpath("//tei:facsimile//tei:graphic/@url", namespaces=NS)
+            expect(
+                len(graphics) == 4 and all(url.startswith("file:") for url in graphics),
+                "enrichment links the cached images",
+            )
+            after = json.loads((work / "iiif" / "index.json").read_text(encoding="utf-8"))["objects"]
+            used = [digest for digest in after if after[digest]["atime"] > before[digest]["atime"]]
+            # manifest and the four renderings
+            expect(len(used) == 5, "enrichment saves the access times of the files it used")
+
+            # room for exactly the files the enrichment used
+            enrich_cache.byte_budget = sum(after[digest]["size"] for digest in used)
+            enrich_cache.evict()
+            expect(
+                sorted(enrich_cache.objects) == sorted(used),
+                "eviction drops the least recently used files first",
+            )
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Serve fake IIIF manifests and images locally, or check the IIIF cache against them."
+    )
+    parser.add_argument("--port", type=int, default=8779, help="Port to listen on.")
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Run prefetch, resume, enrichment and eviction against the fake server and exit.",
+    )
+    args = parser.parse_args()
+    if args.check:
+        check()
+        return
+    with FakeIIIFServer(port=args.port) as server:
+        print(f"Manifests at {server.manifest_url('<name>')} (Ctrl+C to stop)")
+        try:
+            server.thread.join()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,6 @@
+import hashlib
 import json
+from functools import lru_cache
 import requests
 from urllib.parse import urlparse
 import requests
@@ -11,12 +13,26 @@ def load_witnesses_json(file_path):
     with open(file_path, 'r', encoding='utf-8') as f:
         return json.load(f)
 
+@lru_cache(maxsize=None)
 def get_manifest(url):
+    # memoized per process, long-running builds fetch each manifest once
     response = requests.get(url)
     response.raise_for_status()
     return response.json()
 
 
+@lru_cache(maxsize=None)
+def get_manifest_version(url):
+    # ETag or Last-Modified from a HEAD request, else a hash of the manifest
+    response = requests.head(url, allow_redirects=True)
+    if response.ok:
+        validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+        if validator:
+            return validator
+    content = json.dumps(get_manifest(url), sort_keys=True).encode("utf-8")
+    return hashlib.sha256(content).hexdigest()
+
+
 def get_info_json_url(canvas):
     service = canvas["items"][0]["items"][0]["body"]["service"][0]
     return service["id"].rstrip("/") + "/info.json"
@@ -0,0 +1,286 @@
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+from utils import resolve_path_relative_to_script
+from get_images_from_3if import get_info_json_urls, load_witnesses_json
+
+CACHE_DIR = "../.cache/iiif"
+METADATA_PATH = "../metadata/witnesses.json"
+BYTE_BUDGET = 2 * 1024**3
+# IIIF image requests as region/size, relative to the image service
+DEFAULT_IMAGES = ("full/!1000,1000",)
+CHUNK_SIZE = 1 << 16
+
+
+class IIIFCache:
+    """Content-addressed download cache with LRU eviction under a byte budget.
+
+    objects/<sha256[:2]>/<sha256> holds the bytes, index.json maps every URL
+    to its object and keeps size and last access per object. Interrupted
+    downloads stay in partial/ and are resumed with an HTTP Range request.
+    """
+
+    def __init__(self, cache_dir: str = CACHE_DIR, byte_budget: int = BYTE_BUDGET, session_factory=requests.Session):
+        self.root = resolve_path_relative_to_script(cache_dir)
+        self.objects_dir = self.root / "objects"
+        self.partial_dir = self.root / "partial"
+        self.index_path = self.root / "index.json"
+        self.byte_budget = byte_budget
+        self.session_factory = session_factory
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.urls: dict[str, str] = {}
+        self.objects: dict[str, dict] = {}
+        if self.index_path.is_file():
+            with open(self.index_path, "r", encoding="utf-8") as file:
+                index = json.load(file)
+            self.urls = index.get("urls", {})
+            self.objects = index.get("objects", {})
+
+    def session(self) -> requests.Session:
+        # requests sessions are not thread-safe, one per worker
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = self.session_factory()
+        return session
+
+    def object_path(self, digest: str) -> Path:
+        return self.objects_dir / digest[:2] / digest
+
+    def touch(self, digest: str):
+        # in memory only, save_index writes the access times
+        with self.lock:
+            self.objects[digest]["atime"] = time.time()
+
+    def lookup(self, url: str) -> Path | None:
+        digest = self.urls.get(url)
+        if digest is None or not self.object_path(digest).is_file():
+            return None
+        self.touch(digest)
+        return self.object_path(digest)
+
+    def fetch(self, url: str) -> Path:
+        """Path of the cached bytes of url, downloading (or resuming) if needed."""
+        cached = self.lookup(url)
+        if cached is not None:
+            return cached
+        self.partial_dir.mkdir(parents=True, exist_ok=True)
+        partial = self.partial_dir / (hashlib.sha1(url.encode("utf-8")).hexdigest() + ".part")
+        offset = partial.stat().st_size if partial.is_file() else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        with self.session().get(url, headers=headers, stream=True, timeout=60) as response:
+            if response.status_code == 416:
+                # partial file already complete
+                pass
+            else:
+                response.raise_for_status()
+                mode = "ab" if offset and response.status_code == 206 else "wb"
+                with open(partial, mode) as file:
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        file.write(chunk)
+        digest = hashlib.sha256()
+        with open(partial, "rb") as file:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+        digest_hex = digest.hexdigest()
+        target = self.object_path(digest_hex)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        partial.replace(target)
+        with self.lock:
+            self.urls[url] = digest_hex
+            self.objects[digest_hex] = {"size": target.stat().st_size, "atime": time.time()}
+        return target
+
+    def fetch_json(self, url: str) -> dict:
+        with open(self.fetch(url), "r", encoding="utf-8") as file:
+            return json.load(file)
+
+    def evict(self) -> int:
+        """Drop least recently used objects until the cache fits the budget."""
+        freed = 0
+        with self.lock:
+            total = sum(entry["size"] for entry in self.objects.values())
+            for digest in sorted(self.objects, key=lambda d: self.objects[d]["atime"]):
+                if total <= self.byte_budget:
+                    break
+                size = self.objects.pop(digest)["size"]
+                self.object_path(digest).unlink(missing_ok=True)
+                total -= size
+                freed += size
+            self.urls = {url: d for url, d in self.urls.items() if d in self.objects}
+        return freed
+
+    def save_index(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            # copies, fetches in other threads go on while the file is written
+            index = {
+                "urls": dict(self.urls),
+                "objects": {digest: dict(entry) for digest, entry in self.objects.items()},
+            }
+        tmp_file = self.index_path.with_suffix(".json.part")
+        with open(tmp_file, "w", encoding="utf-8") as file:
+            json.dump(index, file)
+        tmp_file.replace(self.index_path)
+
+    def local_url(self, url: str, base_url: str | None = None) -> str:
+        """Where a viewer finds the cached copy of url (file URI or below base_url)."""
+        digest = self.urls.get(url)
+        if digest is None:
+            return url
+        # a file that links the copy uses it, keep it from being evicted first
+        self.touch(digest)
+        if base_url is None:
+            return self.object_path(digest).as_uri()
+        return f"{base_url.rstrip('/')}/objects/{digest[:2]}/{digest}"
+
+    def local_image_url(self, info_url: str, base_url: str | None = None, image: str = DEFAULT_IMAGES[0]) -> str:
+        """Cached rendering of a scan for <graphic @url>; the info.json URL if it was not prefetched."""
+        url = image_urls(info_url, {}, (image,), [])[0]
+        if url not in self.urls:
+            return info_url
+        return self.local_url(url, base_url)
+
+
+def tile_requests(info: dict, scale_factors: list[int]) -> list[str]:
+    # region/size requests for all tiles of the given scale factors (Image API 2/3)
+    requests_list = []
+    for tiles in info.get("tiles", []) if scale_factors else []:
+        width, height = info["width"], info["height"]
+        tile_width = tiles["width"]
+        tile_height = tiles.get("height", tile_width)
+        for scale in scale_factors:
+            if scale not in tiles.get("scaleFactors", []):
+                continue
+            region_width, region_height = tile_width * scale, tile_height * scale
+            for y in range(0, height, region_height):
+                for x in range(0, width, region_width):
+                    w = min(region_width, width - x)
+                    h = min(region_height, height - y)
+                    size = f"{-(-w // scale)},"
+                    requests_list.append(f"{x},{y},{w},{h}/{size}")
+    return requests_list
+
+
+def image_urls(info_url: str, info: dict, images: tuple[str, ...], scale_factors: list[int]) -> list[str]:
+    service = info_url[: -len("/info.json")]
+    return [
+        f"{service}/{request}/0/default.jpg"
+        for request in [*images, *tile_requests(info, scale_factors)]
+    ]
+
+
+def prefetch(
+    cache: IIIFCache,
+    metadata_path: str = METADATA_PATH,
+    sigla: list[str] | None = None,
+    images: tuple[str, ...] = DEFAULT_IMAGES,
+    scale_factors: list[int] | None = None,
+    workers: int = 8,
+) -> tuple[int, int]:
+    """Download info.json and the requested images of every witness scan range."""
+    metadata = load_witnesses_json(resolve_path_relative_to_script(metadata_path))
+    info_urls: list[str] = []
+    for siglum, witness in metadata.items():
+        if sigla is not None and siglum not in sigla:
+            continue
+        manifest_url = witness.get("IIIF_manifest")
+        if manifest_url is None:
+            continue
+        manifest = cache.fetch_json(manifest_url)
+        info_urls.extend(
+            get_info_json_urls(manifest, witness["first_scan"], witness["last_scan"])
+        )
+    # witnesses may share scans; each URL must be downloaded by one worker only
+    info_urls = list(dict.fromkeys(info_urls))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        infos = list(executor.map(lambda url: (url, try_fetch_json(cache, url)), info_urls))
+        downloads = [
+            url
+            for info_url, info in infos
+            if info is not None
+            for url in image_urls(info_url, info, images, scale_factors or [])
+        ]
+        failed = sum(1 for _, info in infos if info is None)
+        fetched = len(infos) - failed
+        for count, ok in enumerate(executor.map(lambda url: try_fetch(cache, url), downloads), start=1):
+            fetched += ok
+            failed += not ok
+            if count % 100 == 0:
+                # an interrupted run loses at most the last hundred index entries
+                cache.save_index()
+    cache.evict()
+    cache.save_index()
+    return fetched, failed
+
+
+def try_fetch(cache: IIIFCache, url: str) -> bool:
+    try:
+        cache.fetch(url)
+        return True
+    except (requests.RequestException, OSError) as exc:
+        print(f"Could not fetch {url}: {exc}")
+        return False
+
+
+def try_fetch_json(cache: IIIFCache, url: str) -> dict | None:
+    try:
+        return cache.fetch_json(url)
+    except (requests.RequestException, OSError, ValueError) as exc:
+        print(f"Could not fetch {url}: {exc}")
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Prefetch IIIF info.json files and images of all witnesses into a local cache."
+    )
+    parser.add_argument("--metadata", default=METADATA_PATH, help="Witness metadata JSON.")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="Cache directory.")
+    parser.add_argument(
+        "--sigla",
+        type=lambda value: [s.strip() for s in value.split(",") if s.strip()],
+        default=None,
+        help="Only these witnesses, e.g. A,D.",
+    )
+    parser.add_argument(
+        "--image",
+        action="append",
+        default=None,
+        help="IIIF region/size to fetch per scan, repeatable (default: full/!1000,1000).",
+    )
+    parser.add_argument(
+        "--tiles",
+        type=int,
+        action="append",
+        default=None,
+        help="Also fetch all tiles of this scale factor, repeatable.",
+    )
+    parser.add_argument(
+        "--budget-mb", type=int, default=BYTE_BUDGET // 1024**2, help="Cache size limit in MB."
+    )
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent downloads.")
+    args = parser.parse_args()
+    cache = IIIFCache(args.cache_dir, args.budget_mb * 1024**2)
+    fetched, failed = prefetch(
+        cache,
+        args.metadata,
+        args.sigla,
+        tuple(args.image) if args.image else DEFAULT_IMAGES,
+        args.tiles,
+        args.workers,
+    )
+    print(f"Cached files: {fetched}, failed: {failed}")
+
+
+if __name__ == "__main__":
+    main()
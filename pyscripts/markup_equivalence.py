@@ -0,0 +1,196 @@
+from __future__ import annotations
+
+import argparse
+import importlib
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Callable, NamedTuple
+
+from lxml import etree
+
+from utils import excel_to_csv
+from table_2_tei import EXCEL_PATH, SUPPORTED_TAGS, Vers, witnesses_from_csv
+
+REFERENCE = "table_2_tei:Witness.convert_vers"
+CHUNK_SIZE = 500
+# building blocks of fuzz verses: plain letters, the abbreviations that clip
+# the preceding letter, gap strings and unknown tags
+FUZZ_TEXT = (
+    "a", "e", "i", "o", "u", "n", "m", "r", "s", "t", "v", "d", "p", "ſ", "â", "ô", " ", " ",
+    "ri", "er", "ra", "ro", "us", "az", "en", "em", "an", "un", "in", "om", "omi",
+    "men", "nn", "vnd", "nd", "per", "rum", "den", "ben", "ff", "st", "12r",
+    "[…]", "[...]", "[..]",
+)
+FUZZ_TAGS = tuple(f"#{tag}" for tag in SUPPORTED_TAGS) + ("#x", "#")
+FUZZ_SIGLA = ("A", "B")
+
+
+class Case(NamedTuple):
+    source: str  # "corpus" or "fuzz"
+    siglum: str
+    global_count: int
+    local_count: int | str
+    text_str: str
+
+
+class Outcome(NamedTuple):
+    tei: bytes | None  # canonical <l>, None if the engine raised
+    errors: tuple[str, ...]  # sorted
+    exception: str | None
+
+
+@lru_cache(maxsize=None)
+def load_engine(spec: str) -> Callable:
+    """"module:attr" -> callable(Vers) -> (<l>, errors); a class is used via its convert_vers."""
+    module_name, _, attr_path = spec.partition(":")
+    engine = importlib.import_module(module_name)
+    for attr in attr_path.split("."):
+        engine = getattr(engine, attr)
+    return getattr(engine, "convert_vers", engine)
+
+
+def run_engine(engine: Callable, case: Case) -> Outcome:
+    verse = Vers(case.global_count, case.local_count, case.text_str, case.siglum)
+    try:
+        vers_elem, errors = engine(verse)
+    except Exception as exc:
+        return Outcome(None, (), f"{type(exc).__name__}: {exc}")
+    canonical = etree.tostring(vers_elem, method="c14n", with_tail=False)
+    # the reference collects errors in a set, their order depends on string
+    # hashing and differs between worker processes
+    return Outcome(canonical, tuple(sorted(errors)), None)
+
+
+def run_chunk(reference: str, candidate: str, cases: list[Case]) -> tuple[list[int], float, float]:
+    """Indices (within the chunk) of diverging cases and the time each engine took."""
+    timings = []
+    outcomes = []
+    for spec in (reference, candidate):
+        engine = load_engine(spec)
+        start = time.perf_counter()
+        outcomes.append([run_engine(engine, case) for case in cases])
+        timings.append(time.perf_counter() - start)
+    diverging = [
+        index for index, (expected, actual) in enumerate(zip(*outcomes)) if expected != actual
+    ]
+    return diverging, timings[0], timings[1]
+
+
+def corpus_cases(csv_path) -> list[Case]:
+    cases = []
+    for siglum, witness in witnesses_from_csv(csv_path).items():
+        for verse in witness.verses:
+            if verse.is_empty():
+                continue
+            cases.append(
+                Case("corpus", siglum, verse.global_count, verse.local_count, verse.text_str)
+            )
+    return cases
+
+
+def fuzz_verse(rng: random.Random) -> str:
+    # mostly well-formed markup, with occasional stray '+' and unclosed tags
+    parts = []
+    depth = 0
+    for _ in range(rng.randint(1, 12)):
+        roll = rng.random()
+        if roll < 0.25:
+            parts.append(rng.choice(FUZZ_TAGS))
+            depth += 1
+        elif roll < 0.45 and depth:
+            parts.append("+")
+            depth -= 1
+        elif roll < 0.48:
+            parts.append("+")
+        else:
+            parts.append(rng.choice(FUZZ_TEXT))
+    if rng.random() < 0.9:
+        parts.append("+" * depth)
+    return "".join(parts)
+
+
+def fuzz_cases(count: int, seed: int) -> list[Case]:
+    rng = random.Random(seed)
+    return [
+        Case("fuzz", rng.choice(FUZZ_SIGLA), n, n, fuzz_verse(rng))
+        for n in range(1, count + 1)
+    ]
+
+
+def compare(reference: str, candidate: str, cases: list[Case], workers: int | None = None) -> dict:
+    """Run both engines over all cases in parallel; returns divergences and timings."""
+    chunks = [cases[i:i + CHUNK_SIZE] for i in range(0, len(cases), CHUNK_SIZE)]
+    diverging: list[int] = []
+    reference_time = candidate_time = 0.0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(
+            run_chunk, [reference] * len(chunks), [candidate] * len(chunks), chunks
+        )
+        for chunk_index, (chunk_diverging, chunk_reference, chunk_candidate) in enumerate(results):
+            diverging.extend(chunk_index * CHUNK_SIZE + index for index in chunk_diverging)
+            reference_time += chunk_reference
+            candidate_time += chunk_candidate
+    return {
+        "cases": len(cases),
+        "diverging": diverging,
+        "reference_time": reference_time,
+        "candidate_time": candidate_time,
+    }
+
+
+def describe_divergence(reference: str, candidate: str, case: Case) -> str:
+    # re-run the case in this process to show both outputs
+    expected = run_engine(load_engine(reference), case)
+    actual = run_engine(load_engine(candidate), case)
+    lines = [
+        f"First divergence ({case.source}, witness {case.siglum}, verse {case.global_count}):",
+        f"  input:     {case.text_str!r}",
+    ]
+    for label, outcome in (("reference", expected), ("candidate", actual)):
+        if outcome.exception is not None:
+            lines.append(f"  {label}: raised {outcome.exception}")
+        else:
+            lines.append(f"  {label}: {outcome.tei.decode('utf-8')}")
+            lines.append(f"  {' ' * len(label)}  errors {list(outcome.errors)}")
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Check that a candidate markup engine produces the same <l> "
+        "elements and markup errors as the reference conversion."
+    )
+    parser.add_argument(
+        "candidate",
+        help="Engine as module:attr, e.g. fast_markup:convert_vers or a class with a "
+        "convert_vers(verse) -> (<l>, errors) staticmethod.",
+    )
+    parser.add_argument("--reference", default=REFERENCE, help=f"Reference engine (default: {REFERENCE}).")
+    parser.add_argument("--csv", default=None, help="Transcription CSV (default: convert the workbook).")
+    parser.add_argument("--no-corpus", action="store_true", help="Only run the fuzz cases.")
+    parser.add_argument("--fuzz", type=int, default=20000, help="Number of fuzz verses.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the fuzz generator.")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes.")
+    args = parser.parse_args()
+
+    cases: list[Case] = []
+    if not args.no_corpus:
+        cases.extend(corpus_cases(args.csv or excel_to_csv(EXCEL_PATH)))
+    cases.extend(fuzz_cases(args.fuzz, args.seed))
+    result = compare(args.reference, args.candidate, cases, args.workers)
+
+    speedup = result["reference_time"] / result["candidate_time"] if result["candidate_time"] else 0.0
+    print(f"Cases: {result['cases']}, diverging: {len(result['diverging'])}")
+    print(
+        f"Reference: {result['reference_time']:.2f}s, candidate: {result['candidate_time']:.2f}s "
+        f"({speedup:.2f}x)"
+    )
+    if result["diverging"]:
+        print(describe_divergence(args.reference, args.candidate, cases[result["diverging"][0]]))
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+from corpus_stats import CorpusStats
+from enrich_tei_with_metadata import (
+    METADATA_PATH,
+    FragmentCache,
+    enrich_tree,
+    infer_siglum_from_file,
+    load_witness_metadata,
+)
+from iiif_cache import IIIFCache
+from shard_tei import write_shards
+from table_2_tei import (
+    Witness,
+    finish_build,
+    log_manifest_failure,
+    log_witness_failure,
+    start_log,
+    witnesses_from_csv,
+)
+from text_layers import write_text_layers
+from token_export import write_token_export
+from token_ir import ir_key, write_ir
+from utils import resolve_path_relative_to_script
+from validate_tei import ValidatorPool
+
+# witnesses waiting between two stages; a full queue holds the stage before it
+QUEUE_SIZE = 2
+FETCH_WORKERS = 4
+
+
+class ManifestFetches:
+    """Manifest checks and downloads of the witnesses, in background threads.
+
+    Created at launch, so the manifests are checked (and downloaded if the
+    cached fragments are outdated) while the workbook is converted and the
+    verses are parsed; inputs() joins one witness.
+    """
+
+    def __init__(
+        self,
+        sigla: list[str] | None = None,
+        metadata_path: str = METADATA_PATH,
+        fragment_cache: FragmentCache | None = None,
+        image_cache: IIIFCache | None = None,
+        image_base_url: str | None = None,
+        workers: int = FETCH_WORKERS,
+    ):
+        metadata_file = resolve_path_relative_to_script(metadata_path)
+        self.metadata = load_witness_metadata(str(metadata_file), metadata_file.stat().st_mtime_ns)
+        self.fragment_cache = fragment_cache if fragment_cache is not None else FragmentCache()
+        self.image_cache = image_cache
+        self.image_base_url = image_base_url
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="manifest")
+        self.futures: dict[str, Future] = {
+            siglum: self.executor.submit(
+                self.fragment_cache.manifest_inputs, siglum, witness, image_cache, image_base_url
+            )
+            for siglum, witness in self.metadata.items()
+            if (sigla is None or siglum in sigla) and "IIIF_manifest" in witness
+        }
+
+    def future(self, siglum: str) -> Future | None:
+        # of FragmentCache.manifest_inputs; None for witnesses without manifest
+        return self.futures.get(siglum)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        if self.image_cache is not None:
+            # one index write for all lookups of the run
+            self.image_cache.save_index()
+
+
+def run_stage(work: Callable, inbox: queue.Queue, outbox: queue.Queue | None):
+    """Apply work to each witness of inbox and pass it on; None ends the stream.
+
+    work returns False for a witness that failed, it is not passed on.
+    """
+    try:
+        while (item := inbox.get()) is not None:
+            if work(*item) is not False and outbox is not None:
+                outbox.put(item)
+    except BaseException:
+        # let the stage before this one finish instead of blocking on put
+        while inbox.get() is not None:
+            pass
+        raise
+    finally:
+        if outbox is not None:
+            outbox.put(None)
+
+
+def run_pipeline(
+    csv_file_path: str,
+    fetches: ManifestFetches | None = None,
+    schema: str | None = None,
+    text_layers: str | None = None,
+    shards: str | None = None,
+    sigla: list[str] | None = None,
+    verses: tuple[int, int] | None = None,
+    stats: bool = False,
+    ir: bool = False,
+    tokens: str | None = None,
+    compress: tuple[str, ...] = (),
+) -> dict[str, Witness]:
+    """Convert the CSV to enriched TEI files in overlapping stages.
+
+    reader -> builder -> validation -> enricher -> writer, each a thread
+    connected by bounded queues. Building is CPU-bound and holds the GIL, so
+    the stages mostly overlap with the waits: manifest downloads (joined
+    only in the enricher), schema validation (in the ValidatorPool, without
+    the GIL) and file output. Each witness is written once, enriched.
+    """
+    selective = sigla is not None or verses is not None
+    if fetches is None:
+        fetches = ManifestFetches(sigla)
+    corpus_stats = CorpusStats() if stats else None
+    witnesses: dict[str, Witness] = {}
+    failed: list[str] = []
+    lock = threading.Lock()
+    # validations run in the pool from the end of the build to the enricher,
+    # which changes the tree, so the check sees the tree as built
+    validator = ValidatorPool(schema) if schema else None
+    validations: dict[str, Future] = {}
+    to_build: queue.Queue = queue.Queue(maxsize=QUEUE_SIZE)
+    to_check: queue.Queue = queue.Queue(maxsize=QUEUE_SIZE)
+    to_enrich: queue.Queue = queue.Queue(maxsize=QUEUE_SIZE)
+    to_write: queue.Queue = queue.Queue(maxsize=QUEUE_SIZE)
+
+    def fail(siglum: str, exc: Exception) -> bool:
+        log_witness_failure(siglum, exc)
+        with lock:
+            failed.append(siglum)
+            del witnesses[siglum]
+        return False
+
+    def read():
+        try:
+            witnesses.update(witnesses_from_csv(csv_file_path, sigla, verses))
+            start_log(witnesses, selective, verses)
+            for siglum, witness in list(witnesses.items()):
+                to_build.put((siglum, witness))
+        finally:
+            to_build.put(None)
+
+    def build(siglum: str, witness: Witness):
+        try:
+            witness.parse_verses()
+            witness.set_filename()
+            if verses is not None:
+                witness.splice_previous(witness.file_path, *verses)
+            witness.add_structure()
+        except Exception as exc:
+            return fail(siglum, exc)
+        if validator is not None:
+            validations[siglum] = validator.submit(witness)
+        if corpus_stats is not None:
+            corpus_stats.add_witness(witness)
+
+    def check(siglum: str, witness: Witness):
+        if validator is None:
+            return
+        try:
+            validator.result(siglum, validations.pop(siglum))
+        except Exception as exc:
+            return fail(siglum, exc)
+
+    def enrich(siglum: str, witness: Witness):
+        siglum_in_file = infer_siglum_from_file(witness.file_path, witness.root)
+        entry = fetches.metadata.get(siglum_in_file)
+        if entry is None:
+            return
+        try:
+            error = enrich_tree(
+                witness.root,
+                siglum_in_file,
+                entry,
+                fetches.fragment_cache,
+                fetches.image_cache,
+                fetches.image_base_url,
+                fetches.future(siglum_in_file),
+                previous_file=witness.file_path,
+            )
+        except Exception as exc:
+            return fail(siglum, exc)
+        if error is not None:
+            log_manifest_failure(siglum, error)
+
+    def write(siglum: str, witness: Witness):
+        try:
+            witness.save_to_file(compress)
+            if text_layers:
+                write_text_layers(witness, witness.file_path.parent, text_layers)
+            if shards:
+                write_shards(witness, witness.file_path.parent, shards)
+        except Exception as exc:
+            return fail(siglum, exc)
+
+    try:
+        with ThreadPoolExecutor(max_workers=5, thread_name_prefix="stage") as executor:
+            stages = [
+                executor.submit(read),
+                executor.submit(run_stage, build, to_build, to_check),
+                executor.submit(run_stage, check, to_check, to_enrich),
+                executor.submit(run_stage, enrich, to_enrich, to_write),
+                executor.submit(run_stage, write, to_write, None),
+            ]
+            for stage in stages:
+                stage.result()
+    finally:
+        fetches.close()
+        if validator is not None:
+            validator.close()
+
+    # whole-corpus outputs, from the witnesses that made it through
+    if ir:
+        write_ir(witnesses, ir_key(csv_file_path, (sigla, verses)))
+    if tokens:
+        write_token_export(witnesses, tokens, selective)
+    finish_build(witnesses, failed, selective, corpus_stats)
+    return witnesses
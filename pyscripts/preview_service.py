@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import argparse
+import json
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from lxml import etree
+
+from table_2_tei import NS, Vers, Witness
+
+HOST = "127.0.0.1"
+PORT = 8765
+
+
+@lru_cache(maxsize=4096)
+def preview_verse(siglum: str, verse_str: str, local_count: int = 1, global_count: int = 1) -> dict:
+    """Convert one cell the way the build does and return TEI plus errors."""
+    verse = Vers(
+        global_count=global_count,
+        local_count=local_count if verse_str.strip() != "" else "",
+        text_str=verse_str,
+        siglum=siglum,
+    )
+    # a cell that raises gives the build's <l type="conversion_error"> too
+    vers_elem, errors = Witness.safe_convert_vers(verse)
+    # attach to a default-namespace parent so the <l> serializes without ns0:
+    wrapper = etree.Element(f"{{{NS['tei']}}}body", nsmap={None: NS["tei"]})
+    wrapper.append(vers_elem)
+    return {
+        "siglum": siglum,
+        "verse": verse_str,
+        "tei": etree.tostring(vers_elem, encoding="unicode", with_tail=False),
+        "errors": [issue_dict(verse, err) for err in errors],
+    }
+
+
+def issue_dict(verse: Vers, message: str) -> dict:
+    # same fields as a line written by log_markup_issue
+    return {
+        "siglum": verse.siglum,
+        "local_count": verse.local_count,
+        "message": message,
+        "text": verse.text_str,
+    }
+
+
+def preview_request(payload: dict | list) -> dict | list:
+    # a single {"siglum", "verse"} object or a list of them (batch)
+    if isinstance(payload, list):
+        return [preview_request(item) for item in payload]
+    if not isinstance(payload, dict) or "verse" not in payload:
+        raise ValueError("expected an object with 'siglum' and 'verse'")
+    return preview_verse(
+        str(payload.get("siglum", "")),
+        str(payload["verse"]),
+        int(payload.get("local_count", 1)),
+        int(payload.get("global_count", 1)),
+    )
+
+
+class PreviewHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/preview":
+            self.send_json(404, {"error": "not found"})
+            return
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.answer(query)
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/preview":
+            self.send_json(404, {"error": "not found"})
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            payload = json.loads(self.rfile.read(length) or b"null")
+        except json.JSONDecodeError as exc:
+            self.send_json(400, {"error": f"invalid JSON: {exc}"})
+            return
+        self.answer(payload)
+
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self.send_cors_headers()
+        self.end_headers()
+
+    def answer(self, payload):
+        try:
+            result = preview_request(payload)
+        except (TypeError, ValueError) as exc:
+            self.send_json(400, {"error": str(exc)})
+            return
+        self.send_json(200, result)
+
+    def send_cors_headers(self):
+        # spreadsheet add-ins call from their own origin
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
+        self.send_header("Access-Control-Allow-Headers", "Content-Type")
+
+    def send_json(self, status: int, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_cors_headers()
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # keep the console quiet, one line per request is too much while typing
+        pass
+
+
+def serve(host: str = HOST, port: int = PORT) -> None:
+    server = ThreadingHTTPServer((host, port), PreviewHandler)
+    print(f"Markup preview on http://{host}:{server.server_port}/preview")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Local HTTP/JSON service previewing the TEI of single verses."
+    )
+    parser.add_argument("--host", default=HOST, help="Interface to bind.")
+    parser.add_argument("--port", type=int, default=PORT, help="Port to listen on.")
+    args = parser.parse_args()
+    serve(args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import json
+from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from lxml import etree
+
+NS_TEI = "http://www.tei-c.org/ns/1.0"
+NS_XML = "http://www.w3.org/XML/1998/namespace"
+NS = {"tei": NS_TEI, "xml": NS_XML}
+SHARD_MODES = ("pb", "group")
+SHARD_DIR = "shards"
+
+
+def page_shards(container: etree._Element) -> list[tuple[str, list[etree._Element]]]:
+    """Split the verses of a witness at its <pb/> elements.
+
+    A verse that opens with a page break starts the new page; a break in the
+    middle of a verse moves the following verses to the new page.
+    """
+    shards: list[tuple[str, list[etree._Element]]] = [("front", [])]
+    for verse in container.iter(f"{{{NS_TEI}}}l"):
+        page_breaks = verse.findall(".//tei:pb", namespaces=NS)
+        if not page_breaks:
+            shards[-1][1].append(verse)
+            continue
+        page = page_breaks[-1].get("n", "")
+        first = page_breaks[0]
+        if first.getparent() is verse and verse.index(first) == 0 and not (verse.text or "").strip():
+            shards.append((page, [verse]))
+        else:
+            shards[-1][1].append(verse)
+            shards.append((page, []))
+    return [(key, verses) for key, verses in shards if verses]
+
+
+def group_shards(container: etree._Element) -> list[tuple[str, list[etree._Element]]]:
+    """One shard per lg[@type='group'] from Witness.add_structure, plus the lines before."""
+    shards: list[tuple[str, list[etree._Element]]] = [("front", [])]
+    for child in container:
+        if etree.QName(child).localname == "lg" and child.get("type") == "group":
+            shards.append((f"group{len(shards)}", [child]))
+        elif len(shards) == 1:
+            shards[0][1].append(child)
+        else:
+            # lines after a group that add_structure did not wrap
+            shards[-1][1].append(child)
+    return [(key, elements) for key, elements in shards if elements]
+
+
+def shallow_copy(elem: etree._Element) -> etree._Element:
+    copy = etree.Element(elem.tag, attrib=dict(elem.attrib))
+    copy.text = None
+    copy.tail = "\n"
+    return copy
+
+
+def build_fragment(
+    container: etree._Element, elements: list[etree._Element]
+) -> etree._Element:
+    """Standalone TEI document holding the elements and their lg ancestors."""
+    root = etree.Element(f"{{{NS_TEI}}}TEI", nsmap={None: NS_TEI})
+    text = etree.SubElement(root, f"{{{NS_TEI}}}text")
+    body = etree.SubElement(text, f"{{{NS_TEI}}}body")
+    witness_lg = shallow_copy(container)
+    body.append(witness_lg)
+    # keep references to the source ancestors so their proxies stay stable
+    copies: dict[etree._Element, etree._Element] = {}
+    for elem in elements:
+        ancestors = []
+        parent = elem.getparent()
+        while parent is not None and parent is not container:
+            ancestors.append(parent)
+            parent = parent.getparent()
+        target = witness_lg
+        for ancestor in reversed(ancestors):
+            if ancestor not in copies:
+                copies[ancestor] = shallow_copy(ancestor)
+                target.append(copies[ancestor])
+            target = copies[ancestor]
+        copy = deepcopy(elem)
+        copy.tail = "\n"
+        target.append(copy)
+    return root
+
+
+def verse_range(elements: list[etree._Element]) -> dict[str, object]:
+    verses = [
+        verse
+        for elem in elements
+        for verse in elem.iter(f"{{{NS_TEI}}}l")
+    ]
+    ids = [v.get(f"{{{NS_XML}}}id") for v in verses if v.get(f"{{{NS_XML}}}id")]
+    return {
+        "verses": len(ids),
+        "first_id": ids[0] if ids else None,
+        "last_id": ids[-1] if ids else None,
+        "first_n": verses[0].get("n") if verses else None,
+        "last_n": verses[-1].get("n") if verses else None,
+    }
+
+
+def write_shards(witness, out_dir: Path, mode: str = "pb", workers: int | None = None) -> Path:
+    """Write the shards of one witness and its manifest.json, return the manifest path."""
+    shard_dir = out_dir / SHARD_DIR / witness.siglum
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    for old_file in shard_dir.glob("*.xml"):
+        old_file.unlink()
+    split = page_shards if mode == "pb" else group_shards
+    jobs: list[tuple[Path, bytes]] = []
+    entries = []
+    for index, (key, elements) in enumerate(split(witness.container), start=1):
+        fragment = build_fragment(witness.container, elements)
+        data = etree.tostring(fragment, encoding="utf-8", xml_declaration=True)
+        file_name = f"{witness.siglum}_{index:04d}.xml"
+        jobs.append((shard_dir / file_name, data))
+        entries.append(
+            {"file": file_name, mode: key, "bytes": len(data), **verse_range(elements)}
+        )
+    # serializing needs the GIL, the writes themselves run in parallel
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda job: job[0].write_bytes(job[1]), jobs))
+    manifest = {"siglum": witness.siglum, "mode": mode, "shards": entries}
+    manifest_path = shard_dir / "manifest.json"
+    with open(manifest_path, "w", encoding="utf-8") as file:
+        json.dump(manifest, file, ensure_ascii=False, indent=2)
+    return manifest_path
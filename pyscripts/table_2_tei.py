@@ -4,6 +4,8 @@ import re
 import logging
 from copy import deepcopy
 import csv
+from functools import lru_cache
+from typing import NamedTuple
 from lxml import etree
 
 from utils import (
@@ -12,7 +14,14 @@ from utils import (
     excel_to_csv,
     user_interaction_loop,
 )
-from enrich_tei_with_metadata import enrich_tei_files
+from validate_tei import SCHEMA_URL
+from text_layers import TEXT_LAYER_FORMATS
+from shard_tei import SHARD_MODES
+from corpus_stats import CorpusStats
+from verse_changes import update_verse_hashes
+from token_export import TOKEN_EXPORT_FORMATS, require_pyarrow
+from tei_writer import COMPRESSED_FORMATS, check_compression, write_tei
+from csv_index import CSVIndex, update_csv_index
 
 OUT_DIR = "../tei"
 TEMPLATE_PATH = "../templates/tei_template.xml"
@@ -21,6 +30,8 @@ NS = {
     "xml": "http://www.w3.org/XML/1998/namespace",
 }
 LOG_FILE = "../logs/markup_errors.log"
+# l/@type of a verse whose conversion raised, see Witness.safe_convert_vers
+CONVERSION_ERROR = "conversion_error"
 EXCEL_PATH = "../data/Transkription.xlsx"
 SUPPORTED_TAGS = {
     "s": "sup",  # Superscript
@@ -36,10 +47,6 @@ SUPPORTED_TAGS = {
     "i": "lombard",  # Lombarde
     "I": "initial",  # Initiale
 }
-csv_path = ""
-# check if csv exists, else convert from excel
-if not Path(resolve_path_relative_to_script(csv_path)).is_file():
-    csv_path = excel_to_csv(EXCEL_PATH)
 
 
 # Mapping from plain text sequences to Unicode ligature glyphs
@@ -60,18 +67,38 @@ CIRCUMFLEX_ALREADY = set("âêîôûÂÊÎÔÛ")
 COMBINING_CIRCUMFLEX = "\u0302"
 
 
+class CircumflexDisplayTable(dict):
+    """str.translate table for #^…+, filled lazily one code point at a time."""
+
+    def __missing__(self, codepoint: int) -> str:
+        ch = chr(codepoint)
+        if ch in CIRCUMFLEX_ALREADY or ch.isspace():
+            value = ch
+        else:
+            value = ch + COMBINING_CIRCUMFLEX
+        self[codepoint] = value
+        return value
+
+
+CIRCUMFLEX_DISPLAY_TABLE = CircumflexDisplayTable()
+# normalized text: ligature glyphs back to their letters ...
+LIGATURE_EXPANSION_TABLE = str.maketrans(
+    {glyph: letters for letters, glyph in LIGATURE_GLYPHS.items()}
+)
+# ... and for #^…+ additionally drop the combining circumflex again
+CIRCUMFLEX_NORMALIZE_TABLE = {
+    **LIGATURE_EXPANSION_TABLE,
+    ord(COMBINING_CIRCUMFLEX): None,
+}
+
+
 def apply_circumflex_display(text: str | None) -> str:
     """Display form for #^…+: add combining circumflex except on â ê î ô û."""
     if not text:
         return ""
-    out: list[str] = []
-    for ch in text:
-        out.append(ch)
-        if ch not in CIRCUMFLEX_ALREADY and not ch.isspace():
-            # Avoid stacking if a combining circumflex is already present next
-            # (handled by iterating base chars only from transcription text).
-            out.append(COMBINING_CIRCUMFLEX)
-    return "".join(out)
+    # Avoid stacking if a combining circumflex is already present next
+    # (handled by iterating base chars only from transcription text).
+    return text.translate(CIRCUMFLEX_DISPLAY_TABLE)
 
 
 def log_markup_issue(log_path: Path, witness_siglum: str, verse: "Vers", message: str):
@@ -84,6 +111,48 @@ def log_markup_issue(log_path: Path, witness_siglum: str, verse: "Vers", message
     )
 
 
+def log_witness_failure(witness_siglum: str, exc: Exception):
+    # same columns as log_markup_issue, without verse
+    logging.error(
+        "%s\t%s\t\t%s\t%s",
+        witness_siglum,
+        "".rjust(6),
+        f"witness not written: {type(exc).__name__}: {exc}",
+        "",
+    )
+
+
+def log_manifest_failure(witness_siglum: str, exc: Exception):
+    # the witness is written, with the facsimile of its previous version
+    logging.error(
+        "%s\t%s\t\t%s\t%s",
+        witness_siglum,
+        "".rjust(6),
+        f"manifest not read, previous facsimile kept: {type(exc).__name__}: {exc}",
+        "",
+    )
+
+
+def configure_logging(filemode: str = "w"):
+    # (re)open the markup error log; force=True lets long-running callers
+    # such as the watch mode start a fresh log for every rebuild
+    logging.basicConfig(
+        filename=str(resolve_path_relative_to_script(LOG_FILE)),
+        filemode=filemode,
+        level=logging.INFO,
+        format="%(levelname)s\t%(message)s",
+        encoding="utf-8",
+        force=True,
+    )
+
+
+@lru_cache(maxsize=4)
+def load_template_tree(path: str, mtime_ns: int) -> etree._ElementTree:
+    # parsed once per template version; witnesses work on deep copies
+    with open(path, "r", encoding="utf-8") as file:
+        return etree.parse(file)
+
+
 # TEI element creation helpers
 def tei(tag, attributes=None):
     elem = etree.Element(f"{{{NS['tei']}}}{tag}")
@@ -424,6 +493,101 @@ class MarkupResolver:
         return errors
 
 
+# Token stream
+
+
+class Token(NamedTuple):
+    kind: str  # text, abbr, lig, rub, circumflex, del, add, unclear, gap, pb, ...
+    dipl: str  # diplomatic form (abbr/orig)
+    norm: str  # normalized form (expan/reg)
+
+
+# token kinds that carry no verse text
+NON_TEXT_KINDS = {"pb"}
+TOKEN_KIND_BY_ATTRIBUTE = {
+    ("hi", "rubric"): "rub",
+    ("hi", "circumflex"): "circumflex",
+    ("c", "initial"): "initial",
+    ("c", "lombard"): "lombard",
+}
+
+
+TEI_PREFIX = f"{{{NS['tei']}}}"
+
+
+def verse_tokens(vers_elem: etree._Element) -> list[Token]:
+    """Flatten a resolved <l> into (kind, diplomatic, normalized) tokens."""
+    tokens: list[Token] = []
+    if len(vers_elem) == 0:
+        # plain verse (or empty row), the common case
+        _emit_token(tokens, "text", vers_elem.text)
+        return tokens
+    _content_tokens(vers_elem, "text", tokens)
+    return tokens
+
+
+def _emit_token(tokens: list[Token], kind: str, text: str | None):
+    if not text:
+        return
+    if kind == "circumflex":
+        norm = text.translate(CIRCUMFLEX_NORMALIZE_TABLE)
+    elif kind == "del":
+        norm = ""
+    else:
+        norm = text.translate(LIGATURE_EXPANSION_TABLE)
+    tokens.append(Token(kind, text, norm))
+
+
+def _content_tokens(elem: etree._Element, kind: str, tokens: list[Token]):
+    _emit_token(tokens, kind, elem.text)
+    for child in elem:
+        _element_tokens(child, kind, tokens)
+        _emit_token(tokens, kind, child.tail)
+
+
+def _part_text(choice: etree._Element, names: tuple[str, str]) -> str:
+    for child in choice:
+        if child.tag in names:
+            return "".join(child.itertext())
+    return ""
+
+
+CHOICE_PARTS = tuple(TEI_PREFIX + name for name in ("abbr", "orig", "expan", "reg"))
+
+
+def _element_tokens(elem: etree._Element, outer_kind: str, tokens: list[Token]):
+    if not isinstance(elem.tag, str):
+        return
+    name = elem.tag[len(TEI_PREFIX):]
+    match name:
+        case "choice":
+            kind = "abbr" if elem[0].tag == CHOICE_PARTS[0] else "lig"
+            tokens.append(
+                Token(
+                    kind,
+                    _part_text(elem, CHOICE_PARTS[:2]),
+                    _part_text(elem, CHOICE_PARTS[2:]),
+                )
+            )
+            # nested markup that was moved into the choice while resolving
+            for child in elem:
+                if child.tag not in CHOICE_PARTS:
+                    _element_tokens(child, kind, tokens)
+                    _emit_token(tokens, kind, child.tail)
+        case "pb":
+            page = elem.get("n", "")
+            tokens.append(Token("pb", page, page))
+        case "gap":
+            tokens.append(Token("gap", "[…]", "[…]"))
+        case "del" | "add" | "unclear" | "wrong_markup":
+            _content_tokens(elem, name, tokens)
+        case _:
+            kind = TOKEN_KIND_BY_ATTRIBUTE.get(
+                (name, elem.get("rend") or elem.get("type")), outer_kind
+            )
+            _content_tokens(elem, kind, tokens)
+
+
 class Vers:
     vers_prefix = "v"
 
@@ -441,16 +605,21 @@ class Vers:
     def is_book_start(self):
         return False
 
-    def to_tei(self):
-        vers_elem = tei("l")
+    def set_numbering(self, vers_elem: etree._Element):
         if not self.local_count and not self.global_count:
             raise ValueError(
                 "At least one of global_count or local_count must be provided"
             )
+        xml_id = f"{{{NS['xml']}}}id"
         if self.local_count != "":
-            vers_elem.set(f"{{{NS['xml']}}}id",
-                          f"{self.vers_prefix}{self.local_count}")
+            vers_elem.set(xml_id, f"{self.vers_prefix}{self.local_count}")
+        elif xml_id in vers_elem.attrib:
+            del vers_elem.attrib[xml_id]
         vers_elem.set("n", f"{self.vers_prefix}{self.global_count}")
+
+    def to_tei(self):
+        vers_elem = tei("l")
+        self.set_numbering(vers_elem)
         markup_str = self.text_str
         errors = MarkupResolver.resolve_markup(
             vers_elem, markup_str, self.siglum)
@@ -467,6 +636,10 @@ class Witness:
         self.body = None
         self.container = None
         self.local_verses = 0
+        self.issues: list[tuple[Vers, str]] = []
+        self.verse_cache: dict[str, tuple[etree._Element, list[str]]] = {}
+        self.parsed: list[tuple[Vers, etree._Element]] = []
+        self.tokens: list[list[Token]] | None = None
         self.load_template()
         self.add_title()
         self.add_siglum_to_header()
@@ -560,19 +733,58 @@ class Witness:
                     f"Could not find parent for gap string in verse {etree.tostring(vers_elem)}"
                 )
 
-    def parse_verses(self):
+    @staticmethod
+    def convert_vers(verse: Vers) -> tuple[etree._Element, list[str]]:
+        # analyze markup first, then resolve it; both error lists are logged
+        errors = list(MarkupResolver.analyze_markup(verse.text_str))
+        vers_elem, resolve_errors = verse.to_tei()
+        errors.extend(resolve_errors)
+        Witness.add_gaps(vers_elem)
+        return vers_elem, errors
+
+    @staticmethod
+    def safe_convert_vers(verse: Vers) -> tuple[etree._Element, list[str]]:
+        # a verse whose conversion raises becomes a marked placeholder with the
+        # raw cell text instead of aborting the whole build
+        try:
+            return Witness.convert_vers(verse)
+        except Exception as exc:
+            vers_elem = tei("l", {"type": CONVERSION_ERROR})
+            verse.set_numbering(vers_elem)
+            vers_elem.text = verse.text_str
+            return vers_elem, [f"conversion failed, raw text kept ({type(exc).__name__}: {exc})"]
+
+    def parse_verses(self, cache: dict | None = None):
+        # with a cache (text_str -> converted <l>, errors) only verses whose
+        # text changed are resolved again; numbering is reapplied on the copy
+        if cache is not None:
+            self.verse_cache = {}
         for verse in self.verses:
             verse: Vers
-            # analyze markup and route any problems to the logger
-            errors = MarkupResolver.analyze_markup(verse.text_str)
-            for err in errors:
-                log_markup_issue(Path(LOG_FILE), self.siglum, verse, err)
-            vers_elem, errors = verse.to_tei()
+            cached = cache.get(verse.text_str) if cache is not None else None
+            if cached is not None:
+                vers_elem = deepcopy(cached[0])
+                verse.set_numbering(vers_elem)
+                errors = cached[1]
+            else:
+                vers_elem, errors = self.safe_convert_vers(verse)
+            if cache is not None and verse.text_str not in self.verse_cache:
+                self.verse_cache[verse.text_str] = (
+                    cached[0] if cached is not None else deepcopy(vers_elem),
+                    errors,
+                )
             for err in errors:
+                self.issues.append((verse, err))
                 log_markup_issue(Path(LOG_FILE), self.siglum, verse, err)
-            self.add_gaps(vers_elem)
+            self.parsed.append((verse, vers_elem))
             self.container.append(vers_elem)
 
+    def verse_tokens(self) -> list[list[Token]]:
+        # computed once on demand and shared by all export stages
+        if self.tokens is None:
+            self.tokens = [verse_tokens(vers_elem) for _, vers_elem in self.parsed]
+        return self.tokens
+
 
     def append_vers_str(self, vers: str):
         self.global_verse_count += 1
@@ -589,16 +801,61 @@ class Witness:
         )
         self.verses.append(vers)
 
+    def skip_verses(self, count: int, text_count: int):
+        # count the verses before the selected range without reading them,
+        # so the numbering of the selected verses stays the same
+        self.global_verse_count += count
+        self.local_verses += text_count
+
     def load_template(self):
         resolved_path = resolve_path_relative_to_script(TEMPLATE_PATH)
-        with open(resolved_path, "r", encoding="utf-8") as file:
-            self.tree = etree.parse(file)
+        self.tree = deepcopy(
+            load_template_tree(str(resolved_path), resolved_path.stat().st_mtime_ns)
+        )
         self.template = deepcopy(self.tree)
         self.root = self.tree.getroot()
         self.body = self.root.find(".//tei:text/tei:body", namespaces=NS)
         self.container = tei("lg", {"type": "witness", "n": self.siglum})
         self.body.append(self.container)
 
+    def splice_previous(self, previous_file: Path, first: int, last: int) -> bool:
+        """Take the verses outside first..last over from the existing file.
+
+        A --verses run converts only its range; the other <l> of the previous
+        <siglum>.xml keep their place, so the file stays complete. Cells filled
+        or emptied in the range shift the local numbering (xml:id) of the verses
+        after it. Call before add_structure, which groups the whole verse
+        sequence again.
+        """
+        if not previous_file.is_file():
+            return False
+        previous = etree.parse(str(previous_file)).getroot()
+        before: list[tuple[Vers, etree._Element]] = []
+        after: list[tuple[Vers, etree._Element]] = []
+        replaced_texts = 0
+        for vers_elem in previous.iter(f"{{{NS['tei']}}}l"):
+            global_count = int(vers_elem.get("n", "").lstrip(Vers.vers_prefix) or 0)
+            local_id = vers_elem.get(f"{{{NS['xml']}}}id", "").lstrip(Vers.vers_prefix)
+            if first <= global_count <= last:
+                replaced_texts += local_id != ""
+                continue
+            # the text is not needed again, only numbering and the element
+            verse = Vers(global_count, int(local_id) if local_id else "", "", self.siglum)
+            (before if global_count < first else after).append((verse, vers_elem))
+        shift = sum(verse.local_count != "" for verse, _ in self.parsed) - replaced_texts
+        if shift:
+            for verse, vers_elem in after:
+                if verse.local_count != "":
+                    verse.local_count += shift
+                    verse.set_numbering(vers_elem)
+        self.parsed = [*before, *self.parsed, *after]
+        for vers_elem in list(self.container):
+            self.container.remove(vers_elem)
+        for _, vers_elem in self.parsed:
+            vers_elem.tail = None
+            self.container.append(vers_elem)
+        return True
+
     def set_filename(self):
         if self.file_path:
             return
@@ -607,53 +864,246 @@ class Witness:
         self.file_path = out_dir_resolved / file_name
         return self.file_path
 
-    def save_to_file(self):
-        with open(self.file_path, "wb") as file:
-            print(
-                f"Saving TEI file for witness {self.siglum} to {self.file_path}")
-            self.tree.write(
-                file, encoding="utf-8", xml_declaration=True, pretty_print=True
-            )
+    def save_to_file(self, compress: tuple[str, ...] = ()):
+        print(
+            f"Saving TEI file for witness {self.siglum} to {self.file_path}")
+        write_tei(self.tree, self.file_path, compress)
+
 
+def parse_verse_range(value: str) -> tuple[int, int]:
+    # "1200-1500" or a single "1200" (global verse numbers, inclusive)
+    start, _, end = value.partition("-")
+    start_n = int(start)
+    end_n = int(end) if end else start_n
+    if start_n < 1 or end_n < start_n:
+        raise ValueError(f"Invalid verse range: {value}")
+    return start_n, end_n
 
-def witnesses_from_csv(file_path: str):
+
+def witnesses_from_csv(
+    file_path: str,
+    sigla: list[str] | None = None,
+    verses: tuple[int, int] | None = None,
+):
     resolved_path = resolve_path_relative_to_script(file_path)
     if not Path(resolved_path).is_file():
         raise FileNotFoundError(f"CSV file not found: {resolved_path}")
     witnesses: dict[str, Witness] = {}
     with open(resolved_path, "r", encoding="utf-8") as csvfile:
-        reader = csv.DictReader(csvfile)
+        reader = csv.reader(csvfile)
         # gonna ignore the first colum (mastercounter)
-        sigla = reader.fieldnames[1:]
+        fieldnames = next(reader)
+        all_sigla = fieldnames[1:]
+        if sigla is None:
+            sigla = all_sigla
+        unknown = [siglum for siglum in sigla if siglum not in all_sigla]
+        if unknown:
+            raise ValueError(f"Unknown sigla: {', '.join(unknown)}")
+        # only the selected columns are read
+        columns = [(fieldnames.index(siglum), siglum) for siglum in sigla]
         for siglum in sigla:
             witnesses[siglum] = Witness(siglum)
-        for row in reader:
-            for siglum in sigla:
-                vers_str = row[siglum]
-                witnesses[siglum].append_vers_str(vers_str)
+        start, end = verses if verses is not None else (1, None)
+        if start <= 1:
+            append_rows(witnesses, columns, enumerate(reader, start=1), end)
+            return witnesses
+    with CSVIndex(resolved_path) as csv_index:
+        # seek to the first selected row; the skipped rows are only counted
+        for _, siglum in columns:
+            witnesses[siglum].skip_verses(start - 1, csv_index.text_count_before(siglum, start))
+        append_rows(witnesses, columns, enumerate(csv_index.rows(start, end), start=start), end)
     return witnesses
 
 
-def csv_to_tei(csv_file_path: str):
-    clear_tei_folder(OUT_DIR)
-    witnesses = witnesses_from_csv(csv_file_path)
-    # configure logging to write a fresh log file on each run
-    logging.basicConfig(
-        filename=str(resolve_path_relative_to_script(LOG_FILE)),
-        filemode="w",  # overwrite on each run
-        level=logging.INFO,
-        format="%(levelname)s\t%(message)s",
-        encoding="utf-8",
+def append_rows(witnesses: dict[str, Witness], columns: list[tuple[int, str]], rows, end: int | None):
+    for row_number, row in rows:
+        if end is not None and row_number > end:
+            break
+        for index, siglum in columns:
+            vers_str = row[index] if index < len(row) else ""
+            witnesses[siglum].append_vers_str(vers_str)
+
+
+def prune_log(witnesses: dict[str, Witness], whole_witness: bool):
+    """Drop the log lines that a selective run is about to write again."""
+    log_path = resolve_path_relative_to_script(LOG_FILE)
+    if not log_path.is_file():
+        return
+    local_ranges = {}
+    for siglum, witness in witnesses.items():
+        counts = [v.local_count for v in witness.verses if v.local_count != ""]
+        local_ranges[siglum] = (min(counts), max(counts)) if counts else (1, 0)
+    kept = []
+    with open(log_path, "r", encoding="utf-8") as file:
+        for line in file:
+            columns = line.split("\t")
+            siglum = columns[1] if len(columns) > 2 else None
+            if siglum not in local_ranges:
+                kept.append(line)
+                continue
+            if whole_witness:
+                continue
+            # column 3 is the local verse count (or the xml:id "vN" of schema issues)
+            number = columns[2].strip().lstrip(Vers.vers_prefix)
+            if not number:
+                # witness-level line (failure), logged again if it still fails
+                continue
+            low, high = local_ranges[siglum]
+            if not number.isdigit() or not low <= int(number) <= high:
+                kept.append(line)
+    with open(log_path, "w", encoding="utf-8") as file:
+        file.writelines(kept)
+
+
+def start_log(witnesses: dict[str, Witness], selective: bool, verses: tuple[int, int] | None):
+    if selective:
+        # files and log lines of the other witnesses are left in place
+        prune_log(witnesses, whole_witness=verses is None)
+        configure_logging(filemode="a")
+    else:
+        # configure logging to write a fresh log file on each run
+        configure_logging(filemode="w")
+
+
+def finish_build(
+    witnesses: dict[str, Witness],
+    failed: list[str],
+    selective: bool,
+    corpus_stats: CorpusStats | None = None,
+):
+    """Steps after all files are saved: stale files, verse hashes, summary."""
+    if not selective:
+        # only now, with the new files in place, remove files of witnesses
+        # that are no longer in the workbook
+        clear_tei_folder(OUT_DIR, keep=[*witnesses, *failed])
+    # rows of failed witnesses stay in the hash table like unselected ones
+    changes = update_verse_hashes(witnesses, selective or bool(failed))
+    for siglum, witness_changes in changes.items():
+        print(
+            f"Changes in {siglum}: "
+            + ", ".join(
+                f"{len(numbers)} {change}"
+                for change, numbers in witness_changes.items()
+                if numbers
+            )
+        )
+    if failed:
+        print(f"Not written (see {LOG_FILE}): {', '.join(failed)}")
+    if corpus_stats is not None:
+        flagged = corpus_stats.write()
+        print(
+            f"Statistics written, {len(flagged)} pages outside the documented lines per page; "
+            f"{len(corpus_stats.skipped)} pages not compared (verses not set off or no lines_per_page)"
+        )
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Convert the transcription workbook into one TEI file per witness."
+    )
+    parser.add_argument(
+        "--validate",
+        nargs="?",
+        const=SCHEMA_URL,
+        default=None,
+        metavar="SCHEMA",
+        help="Validate each witness against a RELAX NG (.rng) or Schematron (.sch) "
+        "schema before saving (default: tei_all).",
+    )
+    parser.add_argument(
+        "--text-layers",
+        choices=TEXT_LAYER_FORMATS,
+        default=None,
+        help="Also write line-aligned diplomatic and normalized text next to "
+        "each <siglum>.xml (txt: two files, jsonl: one record per verse).",
+    )
+    parser.add_argument(
+        "--shards",
+        choices=SHARD_MODES,
+        default=None,
+        help="Also split each witness into small standalone fragments per page (pb) "
+        "or per lg group, with a manifest.json, under shards/<siglum>/.",
+    )
+    parser.add_argument(
+        "--sigla",
+        type=lambda value: [siglum.strip() for siglum in value.split(",") if siglum.strip()],
+        default=None,
+        help="Only convert these witnesses, e.g. A,D; other TEI files are kept.",
+    )
+    parser.add_argument(
+        "--verses",
+        type=parse_verse_range,
+        default=None,
+        help="Only convert this range of global verse numbers, e.g. 1200-1500. "
+        "The other verses are taken over from the existing files.",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Write per-witness, per-page and abbreviation counts to ../stats "
+        "and flag pages outside codicology.lines_per_page.",
     )
-    for witness in witnesses.values():
-        witness.parse_verses()
-        witness.add_structure()
-        witness.set_filename()
-        # etree.indent(witness.tree, space="  ")
-        witness.save_to_file()
+    parser.add_argument(
+        "--ir",
+        action="store_true",
+        help="Store the token stream as a memory-mappable binary IR in .cache/ir "
+        "(keyed by the input hash) for token_ir.py and other consumers.",
+    )
+    parser.add_argument(
+        "--tokens",
+        choices=TOKEN_EXPORT_FORMATS,
+        default=None,
+        help="Write all tokens (siglum, verse, position, dipl, norm, kind, page) "
+        "as one dictionary-encoded Arrow IPC or Parquet file to ../export (needs pyarrow).",
+    )
+    parser.add_argument(
+        "--compress",
+        choices=COMPRESSED_FORMATS,
+        action="append",
+        default=[],
+        help="Also write <siglum>.xml.gz / .xml.zst next to each file, repeatable "
+        "(zst needs Python 3.14 or the zstandard package).",
+    )
+    parser.add_argument(
+        "--refresh-metadata",
+        action="store_true",
+        help="Rebuild the cached msDesc/facsimile fragments in .cache/metadata.",
+    )
+    args = parser.parse_args()
+    # fail before the build, not after it
+    if args.tokens:
+        require_pyarrow()
+    check_compression(tuple(args.compress))
+    # manifests download from here on, during the countdown and the build
+    from enrich_tei_with_metadata import FragmentCache
+    from pipeline import ManifestFetches, run_pipeline
+
+    fetches = ManifestFetches(args.sigla, fragment_cache=FragmentCache(refresh=args.refresh_metadata))
+    try:
+        selective = args.sigla is not None or args.verses is not None
+        if not selective:
+            # a selective run does not clear the output folder
+            user_interaction_loop()
+        csv_path = excel_to_csv(EXCEL_PATH)
+        update_csv_index(csv_path)
+        run_pipeline(
+            csv_path,
+            fetches,
+            schema=args.validate,
+            text_layers=args.text_layers,
+            shards=args.shards,
+            sigla=args.sigla,
+            verses=args.verses,
+            stats=args.stats,
+            ir=args.ir,
+            tokens=args.tokens,
+            compress=tuple(args.compress),
+        )
+    finally:
+        fetches.close()
 
 
 if __name__ == "__main__":
-    user_interaction_loop()
-    csv_to_tei(csv_path)
-    enrich_tei_files()
+    main()
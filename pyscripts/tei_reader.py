@@ -0,0 +1,278 @@
+from __future__ import annotations
+
+import argparse
+import io
+import json
+import mmap
+import re
+from pathlib import Path
+from typing import Iterator
+
+from lxml import etree
+
+from utils import resolve_path_relative_to_script
+
+TEI_DIR = "../tei"
+NS_TEI = "http://www.tei-c.org/ns/1.0"
+NS_XML = "http://www.w3.org/XML/1998/namespace"
+INDEX_SUFFIX = ".idx.json"
+INDEX_VERSION = 1
+
+# start tags of the elements we index; the lookahead keeps <l from matching <lg
+TAG_PATTERN = re.compile(rb"<(l|lg|pb)(?=[\s/>])([^>]*?)(/?)>")
+ATTRIBUTE_PATTERN = re.compile(rb'([\w:]+)="([^"]*)"')
+VERSE_END = b"</l>"
+# fragments are parsed inside a wrapper that declares the TEI default namespace
+WRAPPER_START = f'<wrapper xmlns="{NS_TEI}">'.encode("utf-8")
+WRAPPER_END = b"</wrapper>"
+
+
+def attributes(raw: bytes) -> dict[str, str]:
+    return {
+        name.decode("utf-8"): value.decode("utf-8")
+        for name, value in ATTRIBUTE_PATTERN.findall(raw)
+    }
+
+
+def verse_number(value: str | None) -> int:
+    # "v12" -> 12, missing -> -1
+    if not value:
+        return -1
+    digits = value.lstrip("v")
+    return int(digits) if digits.isdigit() else -1
+
+
+def build_index(data: bytes | mmap.mmap) -> dict:
+    """Byte offsets of every <l>, <pb> and <lg> of a generated TEI file."""
+    verses: list[list[int]] = []  # [local, global, start, end]
+    pages: list[list] = []  # [n, offset, first verse row]
+    groups: list[list] = []  # [type, offset, first verse row]
+    position = 0
+    open_verse_end = -1
+    while True:
+        match = TAG_PATTERN.search(data, position)
+        if match is None:
+            break
+        tag = match.group(1)
+        attrs = attributes(match.group(2))
+        if tag == b"l":
+            start = match.start()
+            if match.group(3):
+                end = match.end()
+            else:
+                end = data.find(VERSE_END, match.end()) + len(VERSE_END)
+            open_verse_end = end
+            verses.append(
+                [
+                    verse_number(attrs.get("xml:id")),
+                    verse_number(attrs.get("n")),
+                    start,
+                    end,
+                ]
+            )
+        elif tag == b"pb":
+            if match.start() < open_verse_end:
+                # a page break that opens its verse starts the page with it,
+                # one in the middle of a verse starts it with the next verse
+                verse_start_tag_end = data.find(b">", verses[-1][2]) + 1
+                leading = data[verse_start_tag_end:match.start()].strip() == b""
+                first_row = len(verses) - 1 if leading else len(verses)
+            else:
+                first_row = len(verses)
+            pages.append([attrs.get("n", ""), match.start(), first_row])
+        else:
+            groups.append([attrs.get("type", ""), match.start(), len(verses)])
+        position = match.end()
+    return {"version": INDEX_VERSION, "verses": verses, "pages": pages, "groups": groups}
+
+
+class TEIReader:
+    """Random access to the verses of one generated <siglum>.xml."""
+
+    def __init__(self, tei_file: Path):
+        self.tei_file = tei_file
+        self.file = open(tei_file, "rb")
+        # of the opened file; a rebuild replaces the path with a new file
+        self.signature = file_signature(tei_file)
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index = self.load_index()
+        verses = self.index["verses"]
+        self.by_local = {row[0]: i for i, row in enumerate(verses) if row[0] >= 0}
+        self.by_global = {row[1]: i for i, row in enumerate(verses) if row[1] >= 0}
+        # pb/@n is not unique (e.g. "?" for unreadable page numbers)
+        self.pages: dict[str, list[int]] = {}
+        for i, page in enumerate(self.index["pages"]):
+            self.pages.setdefault(page[0], []).append(i)
+
+    def is_current(self) -> bool:
+        try:
+            return file_signature(self.tei_file) == self.signature
+        except FileNotFoundError:
+            return False
+
+    def load_index(self) -> dict:
+        # sidecar next to the file, rebuilt when the file changed
+        signature = self.signature
+        sidecar = self.tei_file.with_name(self.tei_file.name + INDEX_SUFFIX)
+        if sidecar.is_file():
+            with open(sidecar, "r", encoding="utf-8") as file:
+                index = json.load(file)
+            if index.get("version") == INDEX_VERSION and index.get("signature") == signature:
+                return index
+        index = build_index(self.data)
+        index["signature"] = signature
+        with open(sidecar, "w", encoding="utf-8") as file:
+            json.dump(index, file)
+        return index
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def row(self, n: int | str, numbering: str = "local") -> int:
+        number = verse_number(n) if isinstance(n, str) else n
+        rows = self.by_local if numbering == "local" else self.by_global
+        if number not in rows:
+            raise KeyError(f"No verse {n} ({numbering}) in {self.tei_file.name}")
+        return rows[number]
+
+    def verse_bytes(self, row: int) -> bytes:
+        _, _, start, end = self.index["verses"][row]
+        return self.data[start:end]
+
+    def get_verse(self, n: int | str, numbering: str = "local") -> etree._Element:
+        """The <l> with xml:id vN (numbering="local") or n="vN" (numbering="global")."""
+        wrapped = WRAPPER_START + self.verse_bytes(self.row(n, numbering)) + WRAPPER_END
+        return etree.fromstring(wrapped)[0]
+
+    def iter_rows(self, rows: range) -> Iterator[etree._Element]:
+        # stream the selected verse slices through iterparse; memory stays
+        # bounded by a single verse no matter how long the range is
+        def chunks():
+            yield WRAPPER_START
+            for row in rows:
+                yield self.verse_bytes(row)
+            yield WRAPPER_END
+
+        stream = ChunkStream(chunks())
+        for _, verse in etree.iterparse(stream, events=("end",), tag=f"{{{NS_TEI}}}l"):
+            # detach the verses already handed out; callers may keep them
+            parent = verse.getparent()
+            while verse.getprevious() is not None:
+                del parent[0]
+            yield verse
+
+    def iter_range(
+        self, first: int | str, last: int | str, numbering: str = "local"
+    ) -> Iterator[etree._Element]:
+        return self.iter_rows(range(self.row(first, numbering), self.row(last, numbering) + 1))
+
+    def iter_page(self, pb_n: str, occurrence: int | None = None) -> Iterator[etree._Element]:
+        """Verses of the page pb/@n; occurrence (1-based) picks one of several pages with that n."""
+        if pb_n not in self.pages:
+            raise KeyError(f"No page {pb_n} in {self.tei_file.name}")
+        candidates = self.pages[pb_n]
+        if occurrence is None:
+            if len(candidates) > 1:
+                raise ValueError(
+                    f"{len(candidates)} pages {pb_n!r} in {self.tei_file.name}, choose one with occurrence"
+                )
+            occurrence = 1
+        if not 1 <= occurrence <= len(candidates):
+            raise KeyError(f"No occurrence {occurrence} of page {pb_n} in {self.tei_file.name}")
+        pages = self.index["pages"]
+        page_index = candidates[occurrence - 1]
+        first_row = pages[page_index][2]
+        if page_index + 1 < len(pages):
+            end_row = pages[page_index + 1][2]
+        else:
+            end_row = len(self.index["verses"])
+        return self.iter_rows(range(first_row, end_row))
+
+
+class ChunkStream(io.RawIOBase):
+    """File-like view over an iterator of byte chunks, for iterparse."""
+
+    def __init__(self, chunks: Iterator[bytes]):
+        self.chunks = chunks
+        self.pending = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self.pending:
+            try:
+                self.pending = next(self.chunks)
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+def file_signature(path: Path) -> list[int]:
+    stat = path.stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+_open_readers: dict[Path, TEIReader] = {}
+
+
+def open_witness(siglum: str, tei_dir: str = TEI_DIR) -> TEIReader:
+    """Reader of tei/<siglum>.xml, reused until the file is rebuilt."""
+    tei_file = resolve_path_relative_to_script(tei_dir) / f"{siglum}.xml"
+    reader = _open_readers.get(tei_file)
+    if reader is None or not reader.is_current():
+        if reader is not None:
+            reader.close()
+        reader = _open_readers[tei_file] = TEIReader(tei_file)
+    return reader
+
+
+def get_verse(siglum: str, n: int | str, numbering: str = "local", tei_dir: str = TEI_DIR) -> etree._Element:
+    return open_witness(siglum, tei_dir).get_verse(n, numbering)
+
+
+def iter_range(
+    siglum: str, first: int | str, last: int | str, numbering: str = "local", tei_dir: str = TEI_DIR
+) -> Iterator[etree._Element]:
+    return open_witness(siglum, tei_dir).iter_range(first, last, numbering)
+
+
+def iter_page(
+    siglum: str, pb_n: str, occurrence: int | None = None, tei_dir: str = TEI_DIR
+) -> Iterator[etree._Element]:
+    return open_witness(siglum, tei_dir).iter_page(pb_n, occurrence)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Print verses of a generated TEI witness without parsing the whole file."
+    )
+    parser.add_argument("siglum", help="Witness siglum, e.g. A.")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--verse", help="Verse number, or a range like 12-20.")
+    group.add_argument("--page", help="Page (pb/@n), e.g. 10r.")
+    parser.add_argument(
+        "--global", dest="numbering", action="store_const", const="global", default="local",
+        help="Interpret --verse as global (n) instead of local (xml:id) numbers.",
+    )
+    parser.add_argument(
+        "--occurrence", type=int, default=None,
+        help="Which of several pages with the same --page value (1 = first).",
+    )
+    parser.add_argument("--tei-dir", default=TEI_DIR, help="Directory of the TEI files.")
+    args = parser.parse_args()
+    if args.page:
+        verses = iter_page(args.siglum, args.page, args.occurrence, args.tei_dir)
+    else:
+        first, _, last = args.verse.partition("-")
+        verses = iter_range(args.siglum, int(first), int(last or first), args.numbering, args.tei_dir)
+    for verse in verses:
+        print(etree.tostring(verse, encoding="unicode", with_tail=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import gzip
+from pathlib import Path
+
+from lxml import etree
+
+try:
+    from compression import zstd  # Python 3.14+
+except ImportError:
+    zstd = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+NS_TEI = "http://www.tei-c.org/ns/1.0"
+COMPRESSED_FORMATS = ("gz", "zst")
+INDENT = "  "
+XML_DECLARATION = b"<?xml version='1.0' encoding='UTF-8'?>\n"
+# content of these elements is text, whitespace in it is never reflowed
+VERBATIM_TAGS = {f"{{{NS_TEI}}}l"}
+GZIP_LEVEL = 9
+ZSTD_LEVEL = 19
+
+
+def is_verbatim(elem: etree._Element) -> bool:
+    if elem.tag in VERBATIM_TAGS or len(elem) == 0 or not isinstance(elem.tag, str):
+        return True
+    # mixed content: any non-whitespace text between the children
+    if elem.text and elem.text.strip():
+        return True
+    return any(child.tail and child.tail.strip() for child in elem)
+
+
+def normalize_layout(root: etree._Element):
+    """Indent element-only content by depth; mixed content is left as it is.
+
+    Only whitespace between elements changes, so the layout no longer depends
+    on the template's formatting or on the tails set while building the tree.
+    """
+    stack = [(root, 0)]
+    while stack:
+        elem, depth = stack.pop()
+        if is_verbatim(elem):
+            continue
+        inner = "\n" + INDENT * (depth + 1)
+        elem.text = inner
+        for child in elem:
+            child.tail = inner
+            if child.tag not in VERBATIM_TAGS:
+                stack.append((child, depth + 1))
+        elem[-1].tail = inner[:-len(INDENT)]
+
+
+def compressed_path(path: Path, fmt: str) -> Path:
+    return path.with_name(f"{path.name}.{fmt}")
+
+
+def open_compressed(fmt: str, raw):
+    # fixed levels and no timestamp/file name in the gzip header keep the
+    # compressed bytes reproducible
+    if fmt == "gz":
+        return gzip.GzipFile(filename="", mode="wb", fileobj=raw, compresslevel=GZIP_LEVEL, mtime=0)
+    if zstd is not None:
+        return zstd.ZstdFile(raw, "wb", level=ZSTD_LEVEL)
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(raw, closefd=False)
+    raise RuntimeError(
+        ".zst output needs Python 3.14 or the zstandard package: pip install zstandard"
+    )
+
+
+def check_compression(formats: tuple[str, ...]):
+    # raise before the build starts rather than when the first file is written
+    if "zst" in formats and zstd is None and zstandard is None:
+        open_compressed("zst", None)
+
+
+class FanOut:
+    """File-like object that passes every write on to several outputs."""
+
+    def __init__(self, outputs: list):
+        self.outputs = outputs
+
+    def write(self, data: bytes) -> int:
+        for output in self.outputs:
+            output.write(data)
+        return len(data)
+
+
+def write_document(root: etree._Element, sink):
+    # declaration and the processing instructions before the root (xml-model)
+    # one per line, then the root element streamed by the incremental writer
+    sink.write(XML_DECLARATION)
+    for node in reversed(list(root.itersiblings(preceding=True))):
+        sink.write(etree.tostring(node, encoding="utf-8", with_tail=False) + b"\n")
+    with etree.xmlfile(sink, encoding="utf-8") as xf:
+        xf.write(root, with_tail=False)
+    sink.write(b"\n")
+
+
+def write_tei(tree: etree._ElementTree, path: Path, compress: tuple[str, ...] | None = ()) -> list[Path]:
+    """Serialize tree to path in the canonical layout, plus .gz/.zst siblings.
+
+    The serializer streams into all outputs at once; every file is written to
+    a temporary name first and replaced only when complete. With
+    compress=None the siblings that already exist are rewritten.
+    """
+    if compress is None:
+        compress = tuple(fmt for fmt in COMPRESSED_FORMATS if compressed_path(path, fmt).is_file())
+    normalize_layout(tree.getroot())
+    targets = [path, *(compressed_path(path, fmt) for fmt in compress)]
+    tmp_paths = [target.with_name(target.name + ".part") for target in targets]
+    raw_files = [open(tmp_path, "wb") for tmp_path in tmp_paths]
+    try:
+        compressors = [open_compressed(fmt, raw) for fmt, raw in zip(compress, raw_files[1:])]
+        sink = FanOut([raw_files[0], *compressors])
+        write_document(tree.getroot(), sink)
+        for compressor in compressors:
+            compressor.close()
+    except BaseException:
+        for raw, tmp_path in zip(raw_files, tmp_paths):
+            raw.close()
+            tmp_path.unlink(missing_ok=True)
+        raise
+    for raw, tmp_path, target in zip(raw_files, tmp_paths, targets):
+        raw.close()
+        tmp_path.replace(target)
+    for fmt in COMPRESSED_FORMATS:
+        if fmt not in compress:
+            # an outdated sibling must not be served instead of the new file
+            compressed_path(path, fmt).unlink(missing_ok=True)
+    return targets
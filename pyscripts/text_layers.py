@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+import json
+from pathlib import Path
+
+TEXT_LAYER_FORMATS = ("txt", "jsonl")
+
+
+def layer_lines(witness) -> list[tuple[str, str, str, str]]:
+    """(n, xml:id, diplomatic, normalized) for every verse row of a witness.
+
+    One entry per row of the sheet (empty rows included), so line k of every
+    witness belongs to Meisterzählung k.
+    """
+    from table_2_tei import NON_TEXT_KINDS
+
+    lines = []
+    for (verse, _), tokens in zip(witness.parsed, witness.verse_tokens()):
+        text_tokens = [token for token in tokens if token.kind not in NON_TEXT_KINDS]
+        lines.append(
+            (
+                f"{verse.vers_prefix}{verse.global_count}",
+                f"{verse.vers_prefix}{verse.local_count}" if verse.local_count != "" else "",
+                " ".join("".join(token.dipl for token in text_tokens).split()),
+                " ".join("".join(token.norm for token in text_tokens).split()),
+            )
+        )
+    return lines
+
+
+def write_text_layers(witness, out_dir: Path, fmt: str = "txt") -> list[Path]:
+    """Write the diplomatic and normalized text next to <siglum>.xml."""
+    lines = layer_lines(witness)
+    if fmt == "jsonl":
+        out_file = out_dir / f"{witness.siglum}.jsonl"
+        with open(out_file, "w", encoding="utf-8") as file:
+            for n, xml_id, diplomatic, normalized in lines:
+                record = {
+                    "n": n,
+                    "id": xml_id,
+                    "diplomatic": diplomatic,
+                    "normalized": normalized,
+                }
+                file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        return [out_file]
+    written = []
+    for index, layer in ((2, "diplomatic"), (3, "normalized")):
+        out_file = out_dir / f"{witness.siglum}.{layer}.txt"
+        with open(out_file, "w", encoding="utf-8") as file:
+            file.writelines(line[index] + "\n" for line in lines)
+        written.append(out_file)
+    return written
@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import re
+from pathlib import Path
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+except ImportError:  # only needed for the token export
+    pa = None
+
+from utils import resolve_path_relative_to_script
+
+EXPORT_DIR = "../export"
+TOKEN_EXPORT_FORMATS = ("arrow", "parquet")
+FILE_NAMES = {"arrow": "tokens.arrow", "parquet": "tokens.parquet"}
+WHITESPACE = re.compile(r"\s+")
+# a word spanning several markup runs gets their kinds, sorted and joined,
+# e.g. "abbr+text"
+KIND_SEPARATOR = "+"
+
+
+def require_pyarrow():
+    if pa is None:
+        raise RuntimeError(
+            "The token export needs pyarrow, install it with: pip install pyarrow"
+        )
+
+
+def token_schema() -> "pa.Schema":
+    # repeated strings are stored once per column (dictionary encoding)
+    text = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema(
+        [
+            ("siglum", pa.dictionary(pa.int8(), pa.string())),
+            ("global", pa.int32()),
+            ("local", pa.int32()),
+            ("position", pa.int32()),
+            ("dipl", text),
+            ("norm", text),
+            ("kind", pa.dictionary(pa.int16(), pa.string())),
+            ("page", pa.dictionary(pa.int32(), pa.string())),
+        ]
+    )
+
+
+def verse_words(tokens: list, page: str | None) -> tuple[list[tuple[str, str, str, str | None]], str | None]:
+    """(dipl, norm, kind, page) per word of a verse, and the page after it.
+
+    verse_tokens gives markup runs; they are split at whitespace and the
+    fragments of a word that crosses markup boundaries ("div gerûche " + abbr
+    "ov" + "ch") are joined again. Page breaks set the page of the next word.
+    """
+    words = []
+    current: list | None = None  # dipl parts, norm parts, kinds, page
+
+    def close():
+        nonlocal current
+        if current is not None:
+            words.append(
+                ("".join(current[0]), "".join(current[1]), KIND_SEPARATOR.join(sorted(current[2])), current[3])
+            )
+            current = None
+
+    for token in tokens:
+        if token.kind == "pb":
+            page = token.dipl
+            continue
+        dipl_parts = WHITESPACE.split(token.dipl)
+        norm_parts = WHITESPACE.split(token.norm)
+        if len(norm_parts) != len(dipl_parts):
+            # the normalized form does not split like the diplomatic one
+            # (deletions, expansions): it goes with the first fragment
+            norm_parts = [token.norm] + [""] * (len(dipl_parts) - 1)
+        for index, (dipl, norm) in enumerate(zip(dipl_parts, norm_parts)):
+            if index > 0:
+                close()
+            if not dipl and not norm:
+                continue
+            if current is None:
+                current = [[], [], set(), page]
+            current[0].append(dipl)
+            current[1].append(norm)
+            current[2].add(token.kind)
+    close()
+    return words, page
+
+
+def token_columns(witness, page: str | None = None) -> dict[str, list]:
+    """One row per word of every verse; page breaks only set the page of what follows."""
+    columns: dict[str, list] = {name: [] for name in token_schema().names}
+    for (verse, _), tokens in zip(witness.parsed, witness.verse_tokens()):
+        words, page = verse_words(tokens, page)
+        for position, (dipl, norm, kind, word_page) in enumerate(words):
+            columns["global"].append(verse.global_count)
+            columns["local"].append(verse.local_count if verse.local_count != "" else None)
+            columns["position"].append(position)
+            columns["dipl"].append(dipl)
+            columns["norm"].append(norm)
+            columns["kind"].append(kind)
+            columns["page"].append(word_page)
+    columns["siglum"] = [witness.siglum] * len(columns["global"])
+    return columns
+
+
+def witness_table(witness, page: str | None = None) -> "pa.Table":
+    schema = token_schema()
+    columns = token_columns(witness, page)
+    return pa.table(
+        {
+            field.name: pa.array(columns[field.name], type=field.type.value_type).dictionary_encode()
+            if pa.types.is_dictionary(field.type)
+            else pa.array(columns[field.name], type=field.type)
+            for field in schema
+        }
+    ).cast(schema)
+
+
+def read_tokens(fmt: str = "arrow", export_dir: str = EXPORT_DIR) -> "pa.Table":
+    """The exported tokens; the Arrow file is memory-mapped, not read into memory."""
+    require_pyarrow()
+    path = resolve_path_relative_to_script(export_dir) / FILE_NAMES[fmt]
+    if fmt == "arrow":
+        return ipc.open_file(pa.memory_map(str(path), "r")).read_all()
+    return pq.read_table(path, memory_map=True)
+
+
+def outside_selection(table: "pa.Table", witnesses: dict) -> "pa.Array":
+    # rows of an earlier export that a selective run did not convert again
+    keep = pa.array([True] * table.num_rows)
+    sigla = pc.cast(table["siglum"], pa.string())
+    for siglum, witness in witnesses.items():
+        if not witness.parsed:
+            continue
+        first = witness.parsed[0][0].global_count
+        last = witness.parsed[-1][0].global_count
+        replaced = pc.and_(
+            pc.equal(sigla, siglum),
+            pc.and_(pc.greater_equal(table["global"], first), pc.less_equal(table["global"], last)),
+        )
+        keep = pc.and_(keep, pc.invert(replaced))
+    return keep
+
+
+def page_before(table: "pa.Table", witness) -> str | None:
+    # a verse range starting mid-witness continues on the page of the last
+    # exported token before it
+    if not witness.parsed:
+        return None
+    earlier = table.filter(
+        pc.and_(
+            pc.equal(pc.cast(table["siglum"], pa.string()), witness.siglum),
+            pc.less(table["global"], witness.parsed[0][0].global_count),
+        )
+    )
+    if earlier.num_rows == 0:
+        return None
+    return earlier["page"][-1].as_py()
+
+
+def in_build_order(table: "pa.Table", sigla: list[str]) -> "pa.Table":
+    # witnesses in column order, then verse and position (sort_by does not
+    # take dictionary columns)
+    order = list(dict.fromkeys(sigla))
+    witness_index = pc.index_in(pc.cast(table["siglum"], pa.string()), value_set=pa.array(order))
+    indices = np.lexsort(
+        (
+            table["position"].to_numpy(),
+            table["global"].to_numpy(),
+            witness_index.to_numpy(zero_copy_only=False),
+        )
+    )
+    return table.take(indices)
+
+
+def write_token_export(
+    witnesses: dict, fmt: str = "arrow", selective: bool = False, export_dir: str = EXPORT_DIR
+) -> Path:
+    """Write the token stream of all witnesses as one Arrow IPC or Parquet file."""
+    require_pyarrow()
+    out_dir = resolve_path_relative_to_script(export_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    out_file = out_dir / FILE_NAMES[fmt]
+    previous = read_tokens(fmt, export_dir) if selective and out_file.is_file() else None
+    tables = [
+        witness_table(witness, page_before(previous, witness) if previous is not None else None)
+        for witness in witnesses.values()
+    ]
+    if previous is not None:
+        tables.insert(0, previous.filter(outside_selection(previous, witnesses)).cast(token_schema()))
+    # one dictionary per column, as required by the Arrow IPC file format
+    table = pa.concat_tables(tables).unify_dictionaries().combine_chunks()
+    if previous is not None:
+        table = in_build_order(table, [*pc.unique(pc.cast(previous["siglum"], pa.string())).to_pylist(), *witnesses])
+    tmp_file = out_file.with_name(out_file.name + ".part")
+    if fmt == "arrow":
+        with pa.OSFile(str(tmp_file), "wb") as sink:
+            with ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+    else:
+        pq.write_table(table, tmp_file, use_dictionary=True)
+    tmp_file.replace(out_file)
+    return out_file
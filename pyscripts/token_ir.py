@@ -0,0 +1,243 @@
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+from pathlib import Path
+
+import numpy as np
+from lxml import etree
+
+from utils import resolve_path_relative_to_script
+
+IR_DIR = "../.cache/ir"
+IR_VERSION = 1
+TEMPLATE_PATH = "../templates/tei_template.xml"
+# the conversion (MarkupResolver, verse_tokens) and the IR layout
+CODE_PATHS = ("table_2_tei.py", "token_ir.py")
+NS_TEI = "http://www.tei-c.org/ns/1.0"
+KINDS = (
+    "text", "abbr", "lig", "rub", "circumflex", "del", "add", "unclear",
+    "gap", "pb", "initial", "lombard", "wrong_markup",
+)
+KIND_INDEX = {kind: index for index, kind in enumerate(KINDS)}
+# verses.structure bit flags: first verse of a lg sub_group / group
+STARTS_SUB_GROUP = 1
+STARTS_GROUP = 2
+
+TOKEN_DTYPE = np.dtype([("kind", "u1"), ("dipl", "<u4"), ("norm", "<u4")])
+VERSE_DTYPE = np.dtype(
+    [
+        ("witness", "<u2"),
+        ("global", "<u4"),
+        ("local", "<i4"),  # -1 for empty rows
+        ("token_start", "<u4"),
+        ("token_end", "<u4"),
+        ("structure", "u1"),
+    ]
+)
+
+
+def ir_key(csv_path: str, selection: object = None) -> str:
+    """Hash of everything the token stream depends on, conversion code included."""
+    digest = hashlib.sha256()
+    digest.update(f"ir{IR_VERSION}:{selection!r}".encode("utf-8"))
+    for path in (csv_path, TEMPLATE_PATH, *CODE_PATHS):
+        digest.update(resolve_path_relative_to_script(path).read_bytes())
+    return digest.hexdigest()[:16]
+
+
+def structure_flags(witness) -> dict[etree._Element, int]:
+    flags: dict[etree._Element, int] = {}
+    for lg in witness.container.iter(f"{{{NS_TEI}}}lg"):
+        flag = {"sub_group": STARTS_SUB_GROUP, "group": STARTS_GROUP}.get(lg.get("type"))
+        if flag is None:
+            continue
+        first = next(lg.iter(f"{{{NS_TEI}}}l"), None)
+        if first is not None:
+            flags[first] = flags.get(first, 0) | flag
+    return flags
+
+
+def write_ir(witnesses: dict, key: str, ir_dir: str = IR_DIR) -> Path:
+    """Write the token stream of all witnesses once; an existing IR is reused."""
+    target = resolve_path_relative_to_script(ir_dir) / key
+    if (target / "meta.json").is_file():
+        return target
+    strings: dict[str, int] = {}
+    tokens: list[tuple[int, int, int]] = []
+    verses: list[tuple[int, int, int, int, int, int]] = []
+    sigla = list(witnesses)
+    for witness_index, witness in enumerate(witnesses.values()):
+        flags = structure_flags(witness)
+        for (verse, vers_elem), verse_tokens in zip(witness.parsed, witness.verse_tokens()):
+            start = len(tokens)
+            for token in verse_tokens:
+                tokens.append(
+                    (
+                        KIND_INDEX[token.kind],
+                        strings.setdefault(token.dipl, len(strings)),
+                        strings.setdefault(token.norm, len(strings)),
+                    )
+                )
+            verses.append(
+                (
+                    witness_index,
+                    verse.global_count,
+                    verse.local_count if verse.local_count != "" else -1,
+                    start,
+                    len(tokens),
+                    flags.get(vers_elem, 0),
+                )
+            )
+    encoded = [text.encode("utf-8") for text in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype="<i8")
+    np.cumsum([len(data) for data in encoded], out=offsets[1:])
+    tmp_target = target.with_name(target.name + ".part")
+    tmp_target.mkdir(parents=True, exist_ok=True)
+    np.save(tmp_target / "strings.npy", np.frombuffer(b"".join(encoded), dtype="u1"))
+    np.save(tmp_target / "string_offsets.npy", offsets)
+    np.save(tmp_target / "tokens.npy", np.array(tokens, dtype=TOKEN_DTYPE))
+    np.save(tmp_target / "verses.npy", np.array(verses, dtype=VERSE_DTYPE))
+    with open(tmp_target / "meta.json", "w", encoding="utf-8") as file:
+        json.dump({"version": IR_VERSION, "key": key, "sigla": sigla, "kinds": KINDS}, file)
+    tmp_target.replace(target)
+    (target.parent / "latest").write_text(key, encoding="utf-8")
+    return target
+
+
+class TokenIR:
+    """Memory-mapped reader for an IR written by write_ir."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        with open(path / "meta.json", "r", encoding="utf-8") as file:
+            self.meta = json.load(file)
+        self.sigla: list[str] = self.meta["sigla"]
+        self.kinds: list[str] = self.meta["kinds"]
+        self.strings = np.load(path / "strings.npy", mmap_mode="r")
+        self.string_offsets = np.load(path / "string_offsets.npy", mmap_mode="r")
+        self.tokens = np.load(path / "tokens.npy", mmap_mode="r")
+        self.verses = np.load(path / "verses.npy", mmap_mode="r")
+        self._decoded: list[str] | None = None
+
+    @classmethod
+    def open(cls, key: str | None = None, ir_dir: str = IR_DIR) -> "TokenIR":
+        # no key: the IR of the most recent build
+        base = resolve_path_relative_to_script(ir_dir)
+        if key is None:
+            key = (base / "latest").read_text(encoding="utf-8").strip()
+        return cls(base / key)
+
+    def string(self, index: int) -> str:
+        start, end = self.string_offsets[index], self.string_offsets[index + 1]
+        return self.strings[start:end].tobytes().decode("utf-8")
+
+    def decoded_strings(self) -> list[str]:
+        # for whole-corpus consumers: decode the string table in one go
+        if self._decoded is None:
+            blob = self.strings.tobytes()
+            offsets = self.string_offsets.tolist()
+            self._decoded = [
+                blob[start:end].decode("utf-8")
+                for start, end in zip(offsets, offsets[1:])
+            ]
+        return self._decoded
+
+    def witness_verses(self, siglum: str) -> np.ndarray:
+        return self.verses[self.verses["witness"] == self.sigla.index(siglum)]
+
+    def verse_tokens(self, verse) -> list[tuple[str, str, str]]:
+        rows = self.tokens[verse["token_start"]:verse["token_end"]]
+        return [
+            (self.kinds[row["kind"]], self.string(row["dipl"]), self.string(row["norm"]))
+            for row in rows
+        ]
+
+    def witness(self, siglum: str) -> "IRWitness":
+        return IRWitness(self, siglum)
+
+
+class IRWitness:
+    """The parts of a built Witness that the export stages read (parsed, verse_tokens)."""
+
+    def __init__(self, ir: TokenIR, siglum: str):
+        from table_2_tei import Token, Vers
+
+        self.siglum = siglum
+        self.verse_rows = ir.witness_verses(siglum)
+        starts = self.verse_rows["token_start"].tolist()
+        ends = self.verse_rows["token_end"].tolist()
+        self.parsed = [
+            (
+                Vers(
+                    global_count=global_count,
+                    local_count=local_count if local_count >= 0 else "",
+                    text_str="",
+                    siglum=siglum,
+                ),
+                None,
+            )
+            for global_count, local_count in zip(
+                self.verse_rows["global"].tolist(), self.verse_rows["local"].tolist()
+            )
+        ]
+        # a witness' tokens are one contiguous block, convert it in one go
+        offset = starts[0] if starts else 0
+        block = ir.tokens[offset:ends[-1] if ends else 0]
+        strings = ir.decoded_strings()
+        kinds = ir.kinds
+        witness_tokens = [
+            Token(kinds[kind], strings[dipl], strings[norm])
+            for kind, dipl, norm in zip(
+                block["kind"].tolist(), block["dipl"].tolist(), block["norm"].tolist()
+            )
+        ]
+        self.tokens = [
+            witness_tokens[start - offset:end - offset] for start, end in zip(starts, ends)
+        ]
+
+    def verse_tokens(self):
+        return self.tokens
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Run export stages from the token IR of a previous build."
+    )
+    parser.add_argument("--key", default=None, help="IR key (default: latest build).")
+    parser.add_argument(
+        "--text-layers", choices=("txt", "jsonl"), default=None,
+        help="Write the text layers to --out-dir.",
+    )
+    parser.add_argument("--stats", action="store_true", help="Write corpus statistics.")
+    parser.add_argument(
+        "--tokens", choices=("arrow", "parquet"), default=None,
+        help="Write the Arrow/Parquet token export.",
+    )
+    parser.add_argument("--out-dir", default="../tei", help="Output folder for text layers.")
+    args = parser.parse_args()
+    ir = TokenIR.open(args.key)
+    witnesses = {siglum: ir.witness(siglum) for siglum in ir.sigla}
+    if args.text_layers:
+        from text_layers import write_text_layers
+
+        out_dir = resolve_path_relative_to_script(args.out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        for witness in witnesses.values():
+            write_text_layers(witness, out_dir, args.text_layers)
+    if args.stats:
+        from corpus_stats import CorpusStats
+
+        corpus_stats = CorpusStats()
+        for witness in witnesses.values():
+            corpus_stats.add_witness(witness)
+        corpus_stats.write()
+    if args.tokens:
+        from token_export import write_token_export
+
+        write_token_export(witnesses, args.tokens)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,13 @@
 from pathlib import Path
 import pandas as pd
 
-def clear_tei_folder(outdir: str):
+def clear_tei_folder(outdir: str, keep=()):
+    # files of the sigla in keep (<siglum>.xml and its .gz/.zst) are left alone
     out_dir_resolved = resolve_path_relative_to_script(outdir)
-    for file in out_dir_resolved.glob("*.xml"):
-        file.unlink()
+    for pattern in ("*.xml", "*.xml.gz", "*.xml.zst"):
+        for file in out_dir_resolved.glob(pattern):
+            if file.name.split(".")[0] not in keep:
+                file.unlink()
 
 def resolve_path_relative_to_script(file_path: str) -> Path:
     # check if path is absolute
@@ -27,7 +30,7 @@ def user_interaction_loop():
 
     nl3 = '\n' * 3
     hash80 = '#' * 80
-    print(f"{nl3}{hash80}{nl3}\nAttention, this will delete all files in the TEI output folder before processing!{nl3}{hash80}")
+    print(f"{nl3}{hash80}{nl3}\nAttention, this will replace all files in the TEI output folder!{nl3}{hash80}")
     sleep_countdown = 5
     print("Press Enter to start immediately, or type anything and press Enter to abort.")
 
@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+import argparse
+import hashlib
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from urllib.parse import urlparse
+
+from lxml import etree, isoschematron
+
+from utils import resolve_path_relative_to_script
+
+# same schema the template references in its xml-model processing instruction
+SCHEMA_URL = "http://www.tei-c.org/release/xml/tei/custom/schema/relaxng/tei_all.rng"
+SCHEMA_CACHE_DIR = "../.cache/schema"
+NS_TEI = "http://www.tei-c.org/ns/1.0"
+NS_XML = "http://www.w3.org/XML/1998/namespace"
+NS_SVRL = "http://purl.oclc.org/dsdl/svrl"
+
+_thread_state = threading.local()
+
+
+def resolve_schema(schema: str) -> Path:
+    """Local path of the schema, downloading remote schemas once into the cache."""
+    parsed_url = urlparse(schema)
+    if not parsed_url.scheme or not parsed_url.netloc:
+        return resolve_path_relative_to_script(schema)
+    cache_dir = resolve_path_relative_to_script(SCHEMA_CACHE_DIR)
+    suffix = Path(parsed_url.path).suffix or ".rng"
+    cached = cache_dir / (hashlib.sha1(schema.encode("utf-8")).hexdigest() + suffix)
+    if not cached.is_file():
+        import requests
+
+        response = requests.get(schema)
+        response.raise_for_status()
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_file = cached.with_suffix(cached.suffix + ".part")
+        tmp_file.write_bytes(response.content)
+        tmp_file.replace(cached)
+    return cached
+
+
+@lru_cache(maxsize=4)
+def parse_schema(path: str, mtime_ns: int) -> etree._ElementTree:
+    return etree.parse(path)
+
+
+def get_validator(schema_path: Path):
+    # lxml validators keep their error_log on the instance, so each worker
+    # thread compiles its own once and reuses it for every witness it checks
+    validators = getattr(_thread_state, "validators", None)
+    if validators is None:
+        validators = _thread_state.validators = {}
+    key = (str(schema_path), schema_path.stat().st_mtime_ns)
+    validator = validators.get(key)
+    if validator is None:
+        schema_doc = parse_schema(*key)
+        if schema_path.suffix == ".sch":
+            # the SVRL report has the location of every assert and report
+            # that fired; the error_log has only the raw SVRL elements
+            validator = isoschematron.Schematron(
+                schema_doc,
+                store_report=True,
+                error_finder=isoschematron.Schematron.ASSERTS_AND_REPORTS,
+            )
+        else:
+            validator = etree.RelaxNG(schema_doc)
+        validators[key] = validator
+    return validator
+
+
+def verse_id_for_path(tree: etree._ElementTree, path: str | None) -> str:
+    # map the XPath of an offending node to the xml:id (or @n) of its verse
+    if not path:
+        return ""
+    try:
+        nodes = tree.xpath(path)
+    except etree.XPathEvalError:
+        return ""
+    if not nodes or not isinstance(nodes[0], etree._Element):
+        return ""
+    verses = nodes[0].xpath("ancestor-or-self::tei:l[1]", namespaces={"tei": NS_TEI})
+    if not verses:
+        return ""
+    verse = verses[0]
+    return verse.get(f"{{{NS_XML}}}id") or verse.get("n", "")
+
+
+def validate_tree(tree: etree._ElementTree, schema_path: Path) -> list[tuple[str, str]]:
+    validator = get_validator(schema_path)
+    if validator.validate(tree):
+        return []
+    if isinstance(validator, isoschematron.Schematron):
+        return [
+            (
+                verse_id_for_path(tree, entry.get("location")),
+                " ".join(entry.findtext(f"{{{NS_SVRL}}}text", "").split()),
+            )
+            for entry in validator.validation_report.getroot()
+            if entry.tag in (f"{{{NS_SVRL}}}failed-assert", f"{{{NS_SVRL}}}successful-report")
+        ]
+    return [
+        (verse_id_for_path(tree, entry.path), entry.message)
+        for entry in validator.error_log
+    ]
+
+
+class ValidatorPool:
+    """Validates witness trees in worker threads, the entry point of the build.
+
+    submit() returns at once (lxml validates without holding the GIL), so
+    callers can go on building while earlier witnesses are checked; result()
+    waits for one witness and logs its violations.
+    """
+
+    def __init__(self, schema: str = SCHEMA_URL, workers: int | None = None):
+        self.schema_path = resolve_schema(schema)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="validate")
+
+    def submit(self, witness) -> Future:
+        return self.executor.submit(validate_tree, witness.tree, self.schema_path)
+
+    def result(self, siglum: str, future: Future) -> list[tuple[str, str]]:
+        violations = future.result()
+        for verse_id, message in violations:
+            log_validation_issue(siglum, verse_id, message)
+        return violations
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self) -> "ValidatorPool":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def validate_witnesses(
+    witnesses: dict, schema: str = SCHEMA_URL, workers: int | None = None
+) -> dict[str, list[tuple[str, str]]]:
+    """Validate every Witness.tree in memory, in parallel; violations are logged."""
+    with ValidatorPool(schema, workers) as pool:
+        futures = {siglum: pool.submit(witness) for siglum, witness in witnesses.items()}
+        return {siglum: pool.result(siglum, future) for siglum, future in futures.items()}
+
+
+def log_validation_issue(witness_siglum: str, verse_id: str, message: str):
+    # same columns as table_2_tei.log_markup_issue
+    logging.error(
+        "%s\t%s\t\t%s\t%s",
+        witness_siglum,
+        verse_id.rjust(6),
+        f"schema: {message}",
+        "",
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Validate TEI files against a RELAX NG or Schematron schema."
+    )
+    parser.add_argument(
+        "--schema",
+        default=SCHEMA_URL,
+        help="Schema URL or path (.rng or .sch); remote schemas are cached.",
+    )
+    parser.add_argument(
+        "--tei-dir",
+        default="../tei",
+        help="Directory containing TEI files to validate.",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None, help="Number of validation threads."
+    )
+    args = parser.parse_args()
+    schema_path = resolve_schema(args.schema)
+    tei_files = sorted(resolve_path_relative_to_script(args.tei_dir).glob("*.xml"))
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        trees = list(executor.map(lambda file: etree.parse(str(file)), tei_files))
+        results = list(
+            executor.map(lambda tree: validate_tree(tree, schema_path), trees)
+        )
+    for tei_file, violations in zip(tei_files, results):
+        for verse_id, message in violations:
+            print(f"{tei_file.stem}\t{verse_id}\t{message}")
+    print(f"Validated {len(tei_files)} files, {sum(map(len, results))} violations")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import csv
+import hashlib
+from pathlib import Path
+
+from lxml import etree
+
+from utils import resolve_path_relative_to_script
+
+HASH_TABLE = "../logs/verse_hashes.tsv"
+CHANGE_REPORT = "../logs/verse_changes.log"
+
+
+def verse_hash(vers_elem: etree._Element) -> str:
+    # canonical (c14n) content of the <l>; its own start tag with xml:id/n is
+    # left out so that shifted local numbering does not count as a change
+    canonical = etree.tostring(vers_elem, method="c14n", with_tail=False)
+    if canonical.endswith(b"/>"):
+        content = b""
+    else:
+        content = canonical[canonical.index(b">") + 1:]
+    return hashlib.blake2b(content, digest_size=8).hexdigest()
+
+
+def witness_hashes(witness) -> dict[tuple[str, int], str]:
+    return {
+        (witness.siglum, verse.global_count): verse_hash(vers_elem)
+        for verse, vers_elem in witness.parsed
+        if verse.local_count != ""
+    }
+
+
+def load_hash_table(path: Path) -> dict[tuple[str, int], str]:
+    if not path.is_file():
+        return {}
+    with open(path, "r", encoding="utf-8", newline="") as file:
+        return {
+            (siglum, int(n)): digest
+            for siglum, n, digest in csv.reader(file, delimiter="\t")
+        }
+
+
+def in_scope(key: tuple[str, int], witnesses: dict) -> bool:
+    # selective runs only replace the rows they actually converted
+    witness = witnesses.get(key[0])
+    if witness is None or not witness.parsed:
+        return False
+    return witness.parsed[0][0].global_count <= key[1] <= witness.parsed[-1][0].global_count
+
+
+def update_verse_hashes(
+    witnesses: dict,
+    selective: bool = False,
+    table_path: str = HASH_TABLE,
+    report_path: str = CHANGE_REPORT,
+) -> dict[str, dict[str, list[int]]]:
+    """Store this build's verse hashes and report what changed since the last build."""
+    table_file = resolve_path_relative_to_script(table_path)
+    first_build = not table_file.is_file()
+    previous = load_hash_table(table_file)
+    current: dict[tuple[str, int], str] = {}
+    for witness in witnesses.values():
+        current.update(witness_hashes(witness))
+    if selective:
+        carried = {key: digest for key, digest in previous.items() if not in_scope(key, witnesses)}
+        previous = {key: digest for key, digest in previous.items() if key not in carried}
+    else:
+        carried = {}
+    changes: dict[str, dict[str, list[int]]] = {}
+
+    def record(siglum: str, change: str, n: int):
+        changes.setdefault(siglum, {"added": [], "removed": [], "modified": []})[change].append(n)
+
+    for key, digest in current.items():
+        if first_build:
+            # nothing to compare with, the table below becomes the baseline
+            break
+        old_digest = previous.get(key)
+        if old_digest is None:
+            record(key[0], "added", key[1])
+        elif old_digest != digest:
+            record(key[0], "modified", key[1])
+    for key in previous.keys() - current.keys():
+        record(key[0], "removed", key[1])
+
+    table = {**carried, **current}
+    with open(table_file, "w", encoding="utf-8", newline="") as file:
+        writer = csv.writer(file, delimiter="\t", lineterminator="\n")
+        for (siglum, n), digest in sorted(table.items()):
+            writer.writerow([siglum, n, digest])
+    write_change_report(resolve_path_relative_to_script(report_path), changes, first_build)
+    return changes
+
+
+def write_change_report(
+    path: Path, changes: dict[str, dict[str, list[int]]], first_build: bool = False
+):
+    with open(path, "w", encoding="utf-8") as file:
+        if first_build:
+            file.write("no previous verse hash table, nothing to compare\n")
+        for siglum in sorted(changes):
+            counts = ", ".join(
+                f"{len(numbers)} {change}" for change, numbers in changes[siglum].items() if numbers
+            )
+            file.write(f"{siglum}\t{counts}\n")
+            for change, numbers in changes[siglum].items():
+                for n in sorted(numbers):
+                    file.write(f"{siglum}\t{change}\tv{n}\n")
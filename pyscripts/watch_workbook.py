@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import argparse
+import logging
+import time
+import zipfile
+from pathlib import Path
+
+from lxml import etree
+
+from utils import resolve_path_relative_to_script, excel_to_csv
+from table_2_tei import (
+    EXCEL_PATH,
+    OUT_DIR,
+    Vers,
+    Witness,
+    configure_logging,
+    log_manifest_failure,
+    log_markup_issue,
+    witnesses_from_csv,
+)
+from enrich_tei_with_metadata import (
+    METADATA_PATH,
+    FragmentCache,
+    enrich_tree,
+    infer_siglum_from_file,
+    load_witness_metadata,
+)
+from csv_index import update_csv_index
+
+POLL_INTERVAL = 0.5
+XLSX_NS = {
+    "main": "http://schemas.openxmlformats.org/spreadsheetml/2006/main",
+    "r": "http://schemas.openxmlformats.org/officeDocument/2006/relationships",
+    "rel": "http://schemas.openxmlformats.org/package/2006/relationships",
+}
+
+
+def first_sheet_signature(workbook: Path) -> tuple:
+    """CRCs of the workbook parts the CSV is made from.
+
+    excel_to_csv reads only the first sheet; the CRCs are stored in the zip
+    directory, so comparing them costs nothing while a parse of the sheet
+    takes most of a rebuild. Edits on other sheets and the save metadata
+    (docProps) do not change the signature.
+    """
+    with zipfile.ZipFile(workbook) as archive:
+        book = etree.fromstring(archive.read("xl/workbook.xml"))
+        rels = etree.fromstring(archive.read("xl/_rels/workbook.xml.rels"))
+        sheet_id = book.find("main:sheets/main:sheet", XLSX_NS).get(f"{{{XLSX_NS['r']}}}id")
+        target = rels.find(f"rel:Relationship[@Id='{sheet_id}']", XLSX_NS).get("Target")
+        first_sheet = "xl/" + target.lstrip("/").removeprefix("xl/")
+        return tuple(
+            (info.filename, info.CRC)
+            for info in archive.infolist()
+            if not info.filename.startswith("docProps/")
+            and (not info.filename.startswith("xl/worksheets/") or info.filename == first_sheet)
+        )
+
+
+class WarmBuild:
+    """Keeps per-witness results in memory and rebuilds only what changed."""
+
+    def __init__(self, excel_path: str = EXCEL_PATH, enrich: bool = True):
+        self.excel_path = excel_path
+        self.enrich = enrich
+        self.fragment_cache = FragmentCache()
+        # siglum -> verse strings of the last build and the issues they produced
+        self.previous: dict[str, tuple[list[str], list[tuple[Vers, str]]]] = {}
+        # siglum -> text_str -> (converted <l>, errors), see Witness.parse_verses
+        self.verse_caches: dict[str, dict] = {}
+        self.signature: tuple | None = None
+
+    def rebuild(self) -> list[str]:
+        signature = first_sheet_signature(resolve_path_relative_to_script(self.excel_path))
+        if signature == self.signature:
+            # saved without a change to the transcription sheet
+            return []
+        csv_path = excel_to_csv(self.excel_path)
+        update_csv_index(csv_path)
+        witnesses = witnesses_from_csv(csv_path)
+        configure_logging(filemode="w")
+        changed: list[str] = []
+        for siglum, witness in witnesses.items():
+            texts = [verse.text_str for verse in witness.verses]
+            previous = self.previous.get(siglum)
+            if previous is not None and previous[0] == texts:
+                # unchanged column: keep the file, only replay its log lines
+                for verse, message in previous[1]:
+                    log_markup_issue(Path(""), siglum, verse, message)
+                continue
+            witness.parse_verses(cache=self.verse_caches.get(siglum, {}))
+            witness.add_structure()
+            witness.set_filename()
+            if self.enrich:
+                self.enrich_witness(witness)
+            witness.save_to_file()
+            self.verse_caches[siglum] = witness.verse_cache
+            self.previous[siglum] = (texts, witness.issues)
+            changed.append(siglum)
+        for siglum in set(self.previous) - set(witnesses):
+            # column removed from the workbook
+            del self.previous[siglum]
+            self.verse_caches.pop(siglum, None)
+            out_dir = resolve_path_relative_to_script(OUT_DIR)
+            for suffix in (".xml", ".xml.gz", ".xml.zst"):
+                (out_dir / f"{siglum}{suffix}").unlink(missing_ok=True)
+        for handler in logging.getLogger().handlers:
+            handler.flush()
+        self.signature = signature
+        return changed
+
+    def enrich_witness(self, witness: Witness):
+        # in memory before the only write, like pipeline.run_pipeline; the
+        # previous facsimile still comes from the file about to be replaced
+        metadata_file = resolve_path_relative_to_script(METADATA_PATH)
+        metadata = load_witness_metadata(str(metadata_file), metadata_file.stat().st_mtime_ns)
+        siglum = infer_siglum_from_file(witness.file_path, witness.root)
+        entry = metadata.get(siglum)
+        if entry is None:
+            return
+        error = enrich_tree(
+            witness.root, siglum, entry, self.fragment_cache, previous_file=witness.file_path
+        )
+        if error is not None:
+            log_manifest_failure(witness.siglum, error)
+
+
+def watch(excel_path: str = EXCEL_PATH, interval: float = POLL_INTERVAL, enrich: bool = True):
+    workbook = resolve_path_relative_to_script(excel_path)
+    build = WarmBuild(excel_path, enrich=enrich)
+    last_seen = None
+    print(f"Watching {workbook} (Ctrl+C to stop)")
+    while True:
+        try:
+            stat = workbook.stat()
+        except FileNotFoundError:
+            time.sleep(interval)
+            continue
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature != last_seen:
+            # wait until the editor has finished writing the file
+            time.sleep(interval)
+            stat = workbook.stat()
+            if (stat.st_mtime_ns, stat.st_size) != signature:
+                continue
+            last_seen = signature
+            start = time.perf_counter()
+            try:
+                changed = build.rebuild()
+            except Exception as exc:
+                print(f"Rebuild failed, waiting for next save: {exc}")
+                continue
+            elapsed = time.perf_counter() - start
+            print(
+                f"[{time.strftime('%H:%M:%S')}] rebuilt "
+                f"{', '.join(changed) or 'nothing'} in {elapsed:.2f}s"
+            )
+        time.sleep(interval)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Rebuild TEI files whenever the transcription workbook is saved."
+    )
+    parser.add_argument(
+        "--excel",
+        default=EXCEL_PATH,
+        help="Path to the workbook (relative to this script or absolute).",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=POLL_INTERVAL,
+        help="Polling interval in seconds.",
+    )
+    parser.add_argument(
+        "--no-enrich",
+        action="store_true",
+        help="Skip the metadata enrichment of rebuilt files.",
+    )
+    args = parser.parse_args()
+    try:
+        watch(args.excel, args.interval, enrich=not args.no_enrich)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()